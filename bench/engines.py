@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import ipaddress
+import json
+import os
+import random
+import sys
+import time
+
+def sample(path, count):
+
+    import maxminddb
+
+    with maxminddb.open_database(path) as reader:
+        networks = [network for network, record in reader]
+
+    ips = []
+    for _ in range(count):
+        network = random.choice(networks)
+        ips.append(str(ipaddress.ip_address(int(network.network_address) + random.randrange(network.num_addresses))))
+
+    return ips
+
+def main(directory, count):
+
+    os.chdir(directory)
+    os.environ['CACHE_SIZE'] = '0'
+    sys.path.insert(0, directory)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+    import geoip2.errors
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        import search
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    random.seed(0)
+    ips = sample('GeoLite2-City.mmdb', count)
+
+    results = {'samples': len(ips)}
+    answers = {}
+    for engine, editions in search.ENGINES.items():
+        if not all(os.path.exists(search.DATABASES[edition]) for edition in editions):
+            continue
+        os.environ['ENGINE'] = engine
+        answers[engine] = []
+        begin = time.perf_counter()
+        for ip in ips:
+            try:
+                answers[engine].append(search.lookup(ip))
+            except geoip2.errors.AddressNotFoundError:
+                answers[engine].append(None)
+        elapsed = time.perf_counter() - begin
+        # country-only answers must not depend on the address also having an AS
+        for ip in ips:
+            try:
+                answers[engine].append(search.lookup(ip, {'c_iso'}))
+            except geoip2.errors.AddressNotFoundError:
+                answers[engine].append(None)
+        results[engine] = {
+            'us_per_lookup': round(elapsed / len(ips) * 1000000, 2),
+            'identical': answers[engine] == answers['mmdb']
+        }
+
+    print(json.dumps(results, indent = 4))
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print('usage: python bench/engines.py <directory with the GeoLite2 databases> [samples]')
+        sys.exit(1)
+    main(os.path.abspath(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) == 3 else 10000)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+import argparse
+import ipaddress
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, os.path.join(ROOT, 'download'))
+
+import download
+
+def carve(base, width, top, low, high):
+
+    start = base
+    end = base + (1 << width - top)
+
+    while start < end:
+        prefixlen = max(random.randint(low, high), top)
+        while start % (1 << width - prefixlen):
+            prefixlen += 1
+        yield start, prefixlen
+        start += 1 << width - prefixlen
+
+def synthetic(directory, scale):
+
+    countries = [('US', 'United States'), ('DE', 'Germany'), ('JP', 'Japan'), ('BR', 'Brazil'), ('NZ', 'New Zealand')]
+    cities = ['Springfield', 'Riverside', 'Fairview', 'Kingston', None]
+    orgs = ['Example Transit', 'Sample Cloud', 'Test Broadband', 'Demo Mobile']
+
+    def city(version, start, prefixlen):
+        iso, country = random.choice(countries)
+        record = {
+            'country': {'iso_code': iso, 'names': {'en': country, 'de': country}},
+            'location': {'latitude': round(random.uniform(-60, 70), 4), 'longitude': round(random.uniform(-180, 180), 4), 'accuracy_radius': 100}
+        }
+        name = random.choice(cities)
+        if name:
+            record['city'] = {'geoname_id': random.randint(1, 1 << 24), 'names': {'en': name}}
+            record['subdivisions'] = [{'iso_code': 'S'+str(random.randint(1, 9)), 'names': {'en': 'Region'}}]
+            record['postal'] = {'code': str(random.randint(10000, 99999))}
+        return version, start, prefixlen, record
+
+    def asn(version, start, prefixlen):
+        return version, start, prefixlen, {
+            'autonomous_system_number': random.randint(1, 400000),
+            'autonomous_system_organization': random.choice(orgs)
+        }
+
+    v4 = [(4, start, prefixlen) for octet in range(1, 224) for start, prefixlen in carve(octet << 24, 32, 8, 12 + scale, 18 + scale)]
+    v6 = [(6, start, prefixlen) for start, prefixlen in carve(0x2000 << 112, 128, 16, 20 + scale, 28 + scale)]
+    # like the real ASN database, leave some of the City address space without an AS
+    asn4 = [(4, start, prefixlen) for octet in range(1, 224) for start, prefixlen in carve(octet << 24, 32, 8, 10 + scale, 20 + scale) if random.random() >= 0.1]
+    asn6 = [(6, start, prefixlen) for start, prefixlen in carve(0x2000 << 112, 128, 16, 18 + scale, 30 + scale) if random.random() >= 0.1]
+
+    download.write_mmdb(os.path.join(directory, 'GeoLite2-City.mmdb'), (city(*network) for network in v4 + v6), 'GeoLite2-City', int(time.time()))
+    download.write_mmdb(os.path.join(directory, 'GeoLite2-ASN.mmdb'), (asn(*network) for network in asn4 + asn6), 'GeoLite2-ASN', int(time.time()))
+
+    return {'fixture': 'synthetic', 'city_networks': len(v4) + len(v6), 'asn_networks': len(asn4) + len(asn6)}
+
+def address(version):
+
+    if version == 4:
+        return str(ipaddress.IPv4Address(random.randint(1 << 24, 224 << 24)))
+    return str(ipaddress.IPv6Address(0x2000 << 112 | random.getrandbits(112)))
+
+def scenarios(count):
+
+    pool = [address(4) for _ in range(10000)]
+    weights = [1 / rank ** 1.1 for rank in range(1, len(pool) + 1)]
+
+    return {
+        'uniform': [address(4) for _ in range(count)],
+        'zipf': random.choices(pool, weights = weights, k = count),
+        'ipv6': [address(6 if random.random() < 0.8 else 4) for _ in range(count)],
+        'invalid': [random.choice(['', 'localhost', '999.1.1.1', '1.2.3', 'fe80::1::1', address(4)]) for _ in range(count)],
+        'batch': [[address(4) for _ in range(100)] for _ in range(max(count // 100, 1))]
+    }
+
+def event(ip):
+
+    if isinstance(ip, list):
+        return {
+            'rawPath': '/',
+            'rawQueryString': '',
+            'headers': {'accept': 'application/json'},
+            'requestContext': {'http': {'method': 'POST', 'path': '/', 'sourceIp': '192.0.2.1'}},
+            'body': json.dumps(ip),
+            'isBase64Encoded': False
+        }
+
+    return {
+        'rawPath': '/'+ip,
+        'rawQueryString': '',
+        'headers': {'accept': 'application/json'},
+        'requestContext': {'http': {'method': 'GET', 'path': '/'+ip, 'sourceIp': '192.0.2.1'}},
+        'isBase64Encoded': False
+    }
+
+def replay(search, events):
+
+    latencies = []
+    begin = time.perf_counter()
+    for item in events:
+        started = time.perf_counter()
+        search.handler(item, None)
+        latencies.append((time.perf_counter() - started) * 1000)
+    elapsed = time.perf_counter() - begin
+
+    tracemalloc.start()
+    for item in events[:max(len(events) // 10, 1)]:
+        search.handler(item, None)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    quantiles = statistics.quantiles(latencies, n = 100) if len(latencies) > 1 else latencies * 99
+
+    return {
+        'requests': len(events),
+        'throughput': round(len(events) / elapsed, 1),
+        'p50_ms': round(quantiles[49], 4),
+        'p95_ms': round(quantiles[94], 4),
+        'p99_ms': round(quantiles[98], 4),
+        'traced_peak_kb': round(peak / 1024, 1)
+    }
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Replay Lambda-shaped lookups through search.handler offline.')
+    parser.add_argument('--release', help = 'GeoLite2.zip release or a directory holding its databases')
+    parser.add_argument('--scale', type = int, default = 0, help = 'extra prefix bits for the synthetic fixture; lower is larger')
+    parser.add_argument('--requests', type = int, default = 10000)
+    parser.add_argument('--engine', default = os.environ.get('ENGINE', 'mmdb'))
+    parser.add_argument('--cache', default = '4096', help = 'CACHE_SIZE for the run')
+    parser.add_argument('--output', help = 'write the results to this JSON file')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    scratch = tempfile.TemporaryDirectory()
+
+    if args.release and zipfile.is_zipfile(args.release):
+        with zipfile.ZipFile(args.release) as zipf:
+            zipf.extractall(scratch.name)
+        directory = scratch.name
+        fixture = {'fixture': os.path.basename(args.release)}
+    elif args.release:
+        directory = os.path.abspath(args.release)
+        fixture = {'fixture': directory}
+    else:
+        directory = scratch.name
+        fixture = synthetic(directory, args.scale)
+
+    os.environ['ENGINE'] = args.engine
+    os.environ['CACHE_SIZE'] = args.cache
+    os.environ['LOG_SAMPLE_RATE'] = '0'
+    os.chdir(directory)
+    sys.path.insert(0, os.path.join(ROOT, 'code'))
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        import search
+        results = {}
+        for name, ips in scenarios(args.requests).items():
+            search.cache_check(None)
+            results[name] = replay(search, [event(ip) for ip in ips])
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = ROOT, capture_output = True, text = True).stdout.strip()
+    except OSError:
+        commit = None
+
+    report = {
+        'commit': commit,
+        'engine': args.engine,
+        'cache_size': int(args.cache),
+        'python': sys.version.split()[0],
+        **fixture,
+        'scenarios': results,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    }
+
+    print(json.dumps(report, indent = 4))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 4)
+
+    scratch.cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'download'))
+
+import download
+
+def main(source):
+
+    entries = []
+    for root, dirs, files in os.walk(source):
+        for file in files:
+            fullpath = os.path.join(root, file)
+            entries.append((fullpath, os.path.relpath(fullpath, source)))
+
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for profile in download.PROFILES:
+            path = os.path.join(scratch, profile+'.zip')
+            stats = download.package(path, entries, profile)
+            stats.update(download.measure(path, os.path.join(scratch, 'measure')))
+            results.append(stats)
+            os.remove(path)
+
+    print(json.dumps(results, indent = 4))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: python bench/package.py <unzipped GeoLite2.zip directory>')
+        sys.exit(1)
+    main(sys.argv[1])
@@ -1,53 +1,1073 @@
+import time
+
+STARTED = time.perf_counter()
+
+import base64
+import bisect
+import collections
+import csv
+import datetime
+import email.utils
 import geoip2.database
+import geoip2.errors
+import io
 import ipaddress
 import json
+import math
+import maxminddb
+import mmap
+import os
+import random
+import struct
+import threading
+import urllib.parse
+
+ATTRIBUTION = 'This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.'
+
+CITY_FIELDS = ('country', 'c_iso', 'state', 's_iso', 'city', 'zip', 'latitude', 'longitude', 'cidr')
+
+ASN_FIELDS = ('asn', 'org')
+
+COUNTRY_FIELDS = ('country', 'c_iso')
+
+FIELDS = CITY_FIELDS + ASN_FIELDS
+
+FORMATS = {
+    'application/json': 'application/json',
+    'application/x-ndjson': 'application/x-ndjson',
+    'text/csv': 'text/csv',
+    'application/msgpack': 'application/msgpack',
+    'application/x-msgpack': 'application/x-msgpack'
+}
+
+DATABASES = {
+    'city': 'GeoLite2-City.mmdb',
+    'asn': 'GeoLite2-ASN.mmdb',
+    'index': 'GeoLite2-Index.bin',
+    'hot': 'GeoLite2-Hot.bin',
+    'reverse': 'GeoLite2-Reverse.bin',
+    'merged': 'GeoLite2-City-ASN.mmdb',
+    'city_raw': 'GeoLite2-City.mmdb',
+    'asn_raw': 'GeoLite2-ASN.mmdb',
+    'country': 'GeoLite2-Country.mmdb',
+    'country_raw': 'GeoLite2-Country.mmdb',
+    'city_tree': 'GeoLite2-City.mmdb',
+    'asn_tree': 'GeoLite2-ASN.mmdb',
+    'merged_tree': 'GeoLite2-City-ASN.mmdb'
+}
+
+ENGINES = {
+    'mmdb': ('city', 'asn'),
+    'index': ('index', 'city', 'asn'),
+    'merged': ('merged',),
+    'raw': ('city_raw', 'asn_raw')
+}
+
+TIERS = {
+    'mmdb': 'country',
+    'raw': 'country_raw'
+}
+
+MODES = {
+    'AUTO': geoip2.database.MODE_AUTO,
+    'MMAP_EXT': geoip2.database.MODE_MMAP_EXT,
+    'MMAP': geoip2.database.MODE_MMAP,
+    'MEMORY': geoip2.database.MODE_MEMORY
+}
+
+UNITS = {
+    'ReaderOpen': 'Milliseconds',
+    'IndexLookup': 'Milliseconds',
+    'HotLookup': 'Milliseconds',
+    'MergedLookup': 'Milliseconds',
+    'RangeWalk': 'Milliseconds',
+    'CityLookup': 'Milliseconds',
+    'CountryLookup': 'Milliseconds',
+    'AsnLookup': 'Milliseconds',
+    'Serialization': 'Milliseconds',
+    'Duration': 'Milliseconds',
+    'CacheHit': 'Count',
+    'CacheMiss': 'Count',
+    'HotHit': 'Count',
+    'DatabaseBuild': 'None'
+}
+
+lock = threading.Lock()
+readers = {}
+metrics = collections.Counter()
+
+def located(edition):
+
+    return os.path.join(os.environ.get('DATABASE_PATH', ''), DATABASES[edition])
+
+def open_index(path):
+
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    with memoryview(buffer) as view:
+        length = int.from_bytes(view[8:16], 'little')
+        header = json.loads(bytes(view[16:16 + length]))
+        base = (16 + length + 7) // 8 * 8
+
+        index = {'build': header['build'], 'buffer': buffer}
+        for column, (typecode, offset, count) in header['sections'].items():
+            size = struct.calcsize(typecode)
+            index[column] = view[base + offset:base + offset + count * size].cast(typecode)
+
+    return index
+
+def open_tree(path):
+
+    with maxminddb.open_database(path) as handle:
+        metadata = handle.metadata()
+
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    tree = {
+        'buffer': buffer,
+        'node_count': metadata.node_count,
+        'record_size': metadata.record_size,
+        'ip_version': metadata.ip_version,
+        'build': metadata.build_epoch
+    }
+
+    node = 0
+    for _ in range(96 if metadata.ip_version == 6 else 0):
+        if node >= metadata.node_count:
+            break
+        node = tree_node(tree, node, 0)
+    tree['ipv4_start'] = node
+
+    return tree
+
+def close(handle):
+
+    if isinstance(handle, dict):
+        for value in handle.values():
+            if isinstance(value, memoryview):
+                value.release()
+        handle['buffer'].close()
+    else:
+        handle.close()
+
+def load(edition):
+
+    path = located(edition)
+    mtime = os.stat(path).st_mtime_ns
+
+    current = readers.get(edition)
+    if current is not None and current['mtime'] == mtime:
+        return current['reader']
+
+    with lock:
+        current = readers.get(edition)
+        if current is not None and current['mtime'] == mtime:
+            return current['reader']
+        if edition in ('index', 'hot', 'reverse'):
+            fresh = open_index(path)
+            build = fresh['build']
+        elif edition.endswith('_tree'):
+            fresh = open_tree(path)
+            build = fresh['build']
+        elif edition in ('merged', 'city_raw', 'asn_raw', 'country_raw'):
+            fresh = maxminddb.open_database(
+                path,
+                MODES[os.environ.get('MMDB_MODE', 'AUTO')]
+            )
+            build = fresh.metadata().build_epoch
+        else:
+            fresh = geoip2.database.Reader(
+                path,
+                mode = MODES[os.environ.get('MMDB_MODE', 'AUTO')]
+            )
+            build = fresh.metadata().build_epoch
+        readers[edition] = {
+            'reader': fresh,
+            'mtime': mtime,
+            'build': build
+        }
+        # requests run one at a time per process, so nothing still holds the replaced reader
+        if current is not None:
+            close(current['reader'])
+
+    return fresh
+
+def reader(edition):
+
+    begin = time.perf_counter()
+    handle = load(edition)
+    clock('ReaderOpen', begin)
+
+    return handle
+
+def clock(name, begin):
+
+    metrics[name] += (time.perf_counter() - begin) * 1000
+
+def string(index, value):
+
+    if value == 0:
+        return None
+
+    offsets = index['str_offsets']
+    return bytes(index['str_blob'][offsets[value]:offsets[value + 1]]).decode()
+
+def index_row(index, address, lo = 0):
+
+    value = int(address)
+
+    if address.version == 4:
+        row = bisect.bisect_right(index['v4_start'], value, lo) - 1
+        if row < 0 or index['v4_end'][row] < value:
+            return None, row
+        return ('v4', row), row
+
+    hi = index['v6_start_hi']
+    start = index['v6_start_lo']
+    row = bisect.bisect_right(range(len(hi)), value, lo, key = lambda i: hi[i] << 64 | start[i]) - 1
+    if row < 0 or (index['v6_end_hi'][row] << 64 | index['v6_end_lo'][row]) < value:
+        return None, row
+    return ('v6', row), row
+
+def index_lookup(index, address, lo = 0):
+
+    found, row = index_row(index, address, lo)
+    if found is None:
+        return None, row
+
+    family = found[0]
+    city = index[family + '_city'][row]
+    asn = index[family + '_asn'][row]
+    latitude = index['city_latitude'][city]
+    longitude = index['city_longitude'][city]
+
+    return {
+        'country':string(index, index['city_country'][city]),
+        'c_iso':string(index, index['city_c_iso'][city]),
+        'state':string(index, index['city_state'][city]),
+        's_iso':string(index, index['city_s_iso'][city]),
+        'city':string(index, index['city_city'][city]),
+        'zip':string(index, index['city_zip'][city]),
+        'latitude':None if math.isnan(latitude) else latitude,
+        'longitude':None if math.isnan(longitude) else longitude,
+        'cidr':str(ipaddress.ip_network((address, index[family + '_prefix'][row]), strict = False)),
+        'asn':index['asn_asn'][asn] or None,
+        'org':string(index, index['asn_org'][asn]),
+        'attribution':ATTRIBUTION
+    }, row
+
+def hot_lookup(hot, address):
+
+    found, row = index_row(hot, address)
+    if found is None:
+        return None
+
+    offsets = hot[found[0] + '_offset']
+    msg = json.loads(bytes(hot['blob'][offsets[row]:offsets[row + 1]]))
+    msg['attribution'] = ATTRIBUTION
+
+    return msg
+
+cache = collections.OrderedDict()
+cache_lengths = collections.Counter()
+cache_stats = {'hits':0, 'misses':0, 'evictions':0, 'flushes':0}
+cache_version = None
+
+def cache_get(address):
+
+    for version, length in cache_lengths:
+        if version != address.version:
+            continue
+        key = (version, int(address) >> (address.max_prefixlen - length), length)
+        msg = cache.get(key)
+        if msg is not None:
+            cache.move_to_end(key)
+            cache_stats['hits'] += 1
+            metrics['CacheHit'] += 1
+            return msg
+
+    cache_stats['misses'] += 1
+    metrics['CacheMiss'] += 1
+    return None
+
+def cache_put(network, msg):
+
+    limit = int(os.environ.get('CACHE_SIZE', '4096'))
+    if limit <= 0:
+        return
+
+    key = (network.version, int(network.network_address) >> (network.max_prefixlen - network.prefixlen), network.prefixlen)
+    if key not in cache:
+        cache_lengths[key[0], key[2]] += 1
+    cache[key] = msg
+    cache.move_to_end(key)
+
+    while len(cache) > limit:
+        old, _ = cache.popitem(last = False)
+        cache_lengths[old[0], old[2]] -= 1
+        if cache_lengths[old[0], old[2]] == 0:
+            del cache_lengths[old[0], old[2]]
+        cache_stats['evictions'] += 1
+
+def cache_check(version):
+
+    global cache_version
+
+    if version != cache_version:
+        if cache_version is not None:
+            cache_stats['flushes'] += 1
+        cache.clear()
+        cache_lengths.clear()
+        cache_version = version
+
+def name(record):
+
+    return record.get('names', {}).get('en')
+
+def render(city, asn, network):
+
+    country = city.get('country', {})
+    subdivision = (city.get('subdivisions') or [{}])[-1]
+    location = city.get('location', {})
+
+    return {
+        'country':name(country),
+        'c_iso':country.get('iso_code'),
+        'state':name(subdivision),
+        's_iso':subdivision.get('iso_code'),
+        'city':name(city.get('city', {})),
+        'zip':city.get('postal', {}).get('code'),
+        'latitude':location.get('latitude'),
+        'longitude':location.get('longitude'),
+        'cidr':str(network),
+        'asn':asn.get('autonomous_system_number'),
+        'org':asn.get('autonomous_system_organization'),
+        'attribution':ATTRIBUTION
+    }
+
+def project(msg, fields):
+
+    if fields is None:
+        return msg
+
+    return {key: value for key, value in msg.items() if key in fields or key == 'attribution'}
+
+def selection(query):
+
+    if not query.get('fields'):
+        return None
+
+    fields = {field.strip() for field in query['fields'].split(',') if field.strip()}
+    if not fields or not fields <= set(FIELDS):
+        raise ValueError('unknown field')
+
+    return fields
+
+def lookup(ip, fields = None):
+
+    address = ipaddress.ip_address(ip)
+    engine = os.environ.get('ENGINE', 'mmdb')
+
+    if os.path.exists(located('hot')):
+        hot = reader('hot')
+        begin = time.perf_counter()
+        msg = hot_lookup(hot, address)
+        clock('HotLookup', begin)
+        if msg is not None:
+            metrics['HotHit'] += 1
+            return project(msg, fields)
+
+    if engine == 'index':
+        index = reader('index')
+        begin = time.perf_counter()
+        msg, row = index_lookup(index, address)
+        clock('IndexLookup', begin)
+        if msg is not None:
+            return project(msg, fields)
+
+    editions = ENGINES['mmdb' if engine == 'index' else engine]
+    handles = [reader(edition) for edition in editions]
+    cache_check(tuple((readers[edition]['build'], readers[edition]['mtime']) for edition in editions))
+
+    msg = cache_get(address)
+    if msg is not None:
+        return project(msg, fields)
+
+    city = fields is None or not fields.isdisjoint(CITY_FIELDS)
+    asn = fields is None or not fields.isdisjoint(ASN_FIELDS)
+
+    if engine == 'merged':
+
+        begin = time.perf_counter()
+        record, prefixlen = handles[0].get_with_prefix_len(address)
+        clock('MergedLookup', begin)
+        if record is None:
+            raise geoip2.errors.AddressNotFoundError(ip)
+        traits = record.get('traits', {})
+        # pieces only one database covers lack the other section, like a miss in that database
+        found = ('country' in record, 'autonomous_system_number' in traits)
+        if (city and not found[0]) or (asn and not found[1]):
+            raise geoip2.errors.AddressNotFoundError(ip)
+        network = ipaddress.ip_network((address, prefixlen), strict = False)
+        msg = render(record, traits, ipaddress.ip_network((address, prefixlen - traits.get('city_prefix_delta', 0)), strict = False))
+
+        if all(found):
+            cache_put(network, msg)
+
+        return project(msg, fields)
+
+    # country-only answers come from the smaller Country tree when it is packaged
+    tier = TIERS.get('mmdb' if engine == 'index' else engine)
+    country = city and tier is not None and fields is not None and fields <= set(COUNTRY_FIELDS + ASN_FIELDS) and os.path.exists(located(tier))
+    if country:
+        handles = [reader(tier), handles[1]]
+
+    if engine == 'raw':
+        msg, network = raw_lookup(handles, address, city, asn, country)
+    else:
+        msg, network = model_lookup(handles, ip, city, asn, country)
+
+    if city and asn and not country:
+        cache_put(network, msg)
+
+    return project(msg, fields)
+
+def model_lookup(handles, ip, city, asn, country = False):
+
+    msg = {}
+
+    if country:
+        begin = time.perf_counter()
+        response = handles[0].country(ip)
+        clock('CountryLookup', begin)
+        msg.update({
+            'country':response.country.name,
+            'c_iso':response.country.iso_code
+        })
+    elif city:
+        begin = time.perf_counter()
+        response = handles[0].city(ip)
+        clock('CityLookup', begin)
+        msg.update({
+            'country':response.country.name,
+            'c_iso':response.country.iso_code,
+            'state':response.subdivisions.most_specific.name,
+            's_iso':response.subdivisions.most_specific.iso_code,
+            'city':response.city.name,
+            'zip':response.postal.code,
+            'latitude':response.location.latitude,
+            'longitude':response.location.longitude,
+            'cidr':str(response.traits.network)
+        })
+
+    if asn:
+        begin = time.perf_counter()
+        response2 = handles[1].asn(ip)
+        clock('AsnLookup', begin)
+        msg.update({
+            'asn':response2.autonomous_system_number,
+            'org':response2.autonomous_system_organization
+        })
+
+    msg['attribution'] = ATTRIBUTION
+
+    if country or not (city and asn):
+        return msg, None
+
+    # the answer holds for every address in both networks, i.e. the longer prefix
+    if response.traits.network.prefixlen >= response2.network.prefixlen:
+        return msg, response.traits.network
+    return msg, response2.network
+
+def raw_lookup(handles, address, city, asn, country = False):
+
+    record = record2 = {}
+    network = network2 = None
+
+    if city:
+        begin = time.perf_counter()
+        record, prefixlen = handles[0].get_with_prefix_len(address)
+        clock('CountryLookup' if country else 'CityLookup', begin)
+        if record is None:
+            raise geoip2.errors.AddressNotFoundError(str(address))
+        network = ipaddress.ip_network((address, prefixlen), strict = False)
+
+    if asn:
+        begin = time.perf_counter()
+        record2, prefixlen2 = handles[1].get_with_prefix_len(address)
+        clock('AsnLookup', begin)
+        if record2 is None:
+            raise geoip2.errors.AddressNotFoundError(str(address))
+        network2 = ipaddress.ip_network((address, prefixlen2), strict = False)
+
+    msg = render(record, record2, network)
+    if not city:
+        msg = {key: value for key, value in msg.items() if key not in CITY_FIELDS}
+    if not asn:
+        msg = {key: value for key, value in msg.items() if key not in ASN_FIELDS}
+
+    if not (city and asn):
+        return msg, None
+
+    if network.prefixlen >= network2.prefixlen:
+        return msg, network
+    return msg, network2
+
+def batch(body, fields = None):
+
+    ips = json.loads(body)
+    if isinstance(ips, dict):
+        ips = ips['ips']
+    if not isinstance(ips, list):
+        raise ValueError('expected a list of addresses')
+    if len(ips) > int(os.environ.get('BATCH_LIMIT', '1000')):
+        raise ValueError('too many addresses')
+
+    unique = list(dict.fromkeys(str(ip).strip() for ip in ips))
+
+    parsed = {}
+    results = {}
+    for ip in unique:
+        try:
+            parsed[ip] = ipaddress.ip_address(ip)
+        except ValueError:
+            results[ip] = {'ip':ip, 'error':'Invalid Address'}
+
+    engine = os.environ.get('ENGINE', 'mmdb')
+    lo = {4: 0, 6: 0}
+
+    for ip in sorted(parsed, key = lambda ip: (parsed[ip].version, parsed[ip])):
+        if engine == 'index':
+            address = parsed[ip]
+            index = reader('index')
+            begin = time.perf_counter()
+            msg, row = index_lookup(index, address, lo[address.version])
+            clock('IndexLookup', begin)
+            lo[address.version] = max(row, 0)
+            if msg is not None:
+                results[ip] = {'ip':ip, **project(msg, fields)}
+                continue
+        try:
+            results[ip] = {'ip':ip, **lookup(ip, fields)}
+        except geoip2.errors.AddressNotFoundError:
+            results[ip] = {'ip':ip, 'error':'Where the Internet Ends'}
+
+    return [results[ip] for ip in unique]
+
+def tree_node(tree, node, bit):
+
+    if node >= tree['node_count']:
+        return node
+
+    buffer = tree['buffer']
+
+    if tree['record_size'] == 24:
+        offset = node * 6 + bit * 3
+        return int.from_bytes(buffer[offset:offset + 3], 'big')
+
+    if tree['record_size'] == 28:
+        offset = node * 7
+        if bit:
+            return (buffer[offset + 3] & 0x0F) << 24 | int.from_bytes(buffer[offset + 4:offset + 7], 'big')
+        return (buffer[offset + 3] & 0xF0) << 20 | int.from_bytes(buffer[offset:offset + 3], 'big')
+
+    offset = node * 8 + bit * 4
+    return int.from_bytes(buffer[offset:offset + 4], 'big')
+
+def walk(trees, network, after, budget):
+
+    width = network.max_prefixlen
+    value = int(network.network_address)
+
+    nodes = []
+    for tree in trees:
+        if network.version == 6 and tree['ip_version'] == 4:
+            nodes.append(tree['node_count'])
+        else:
+            nodes.append(tree['ipv4_start'] if network.version == 4 else 0)
+
+    for depth in range(network.prefixlen):
+        bit = value >> (width - 1 - depth) & 1
+        nodes = [tree_node(tree, node, bit) for tree, node in zip(trees, nodes)]
+
+    stack = [(nodes, value, network.prefixlen)]
+    while stack:
+        nodes, value, depth = stack.pop()
+        if value | (1 << width - depth) - 1 < after:
+            continue
+        budget -= 1
+        if budget < 0:
+            yield value, None, None
+            return
+        if all(node >= tree['node_count'] for tree, node in zip(trees, nodes)):
+            if any(node > tree['node_count'] for tree, node in zip(trees, nodes)):
+                yield value, depth, [node if node > tree['node_count'] else None for tree, node in zip(trees, nodes)]
+            continue
+        for bit in (1, 0):
+            stack.append((
+                [tree_node(tree, node, bit) for tree, node in zip(trees, nodes)],
+                value | bit << (width - 1 - depth),
+                depth + 1
+            ))
+
+def page_size(limit):
+
+    cap = int(os.environ.get('RANGE_LIMIT', '1000'))
+    limit = min(int(limit or cap), cap)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+
+    return limit
+
+def enumerate_networks(cidr, after = None, limit = None, fields = None):
+
+    network = ipaddress.ip_network(cidr, strict = False)
+    limit = page_size(limit)
+
+    start = int(network.network_address)
+    if after:
+        start = int(ipaddress.ip_address(after))
+        if start not in range(int(network.network_address), int(network.broadcast_address) + 1):
+            raise ValueError('after is outside the network')
+
+    merged = os.environ.get('ENGINE', 'mmdb') == 'merged'
+    if merged:
+        trees = [reader('merged_tree')]
+        handles = [reader('merged')]
+    else:
+        trees = [reader('city_tree'), reader('asn_tree')]
+        handles = [reader('city_raw'), reader('asn_raw')]
+
+    kind = type(network.network_address)
+
+    records = {}
+    rows = []
+    following = None
+
+    begin = time.perf_counter()
+    for value, depth, pointers in walk(trees, network, start, limit * 64):
+        if depth is None or len(rows) == limit:
+            following = max(value, start)
+            break
+        piece = ipaddress.ip_network((kind(value), depth))
+        found = []
+        for handle, pointer in zip(handles, pointers):
+            if pointer is None:
+                found.append({})
+                continue
+            if (handle, pointer) not in records:
+                records[handle, pointer] = handle.get(piece.network_address) or {}
+            found.append(records[handle, pointer])
+        if merged:
+            msg = render(found[0], found[0].get('traits', {}), piece)
+        else:
+            msg = render(found[0], found[1], piece)
+        rows.append({key: value for key, value in msg.items() if key != 'attribution' and (fields is None or key in fields or key == 'cidr')})
+    clock('RangeWalk', begin)
+
+    return {
+        'network': str(network),
+        'networks': rows,
+        'after': None if following is None else str(kind(following)),
+        'attribution': ATTRIBUTION
+    }
+
+def reverse(kind, key, after = None, limit = None):
+
+    limit = page_size(limit)
+
+    if not os.path.exists(located('reverse')):
+        return None
+    index = reader('reverse')
+
+    if kind == 'org':
+        prefix = key.lower()
+        keys = index['asn_keys']
+        rows = index['org_rows']
+        org = lambda row: string(index, index['asn_org'][row])
+        position = lambda i: (org(rows[i]).lower(), keys[rows[i]])
+        first = bisect.bisect_left(range(len(rows)), (prefix,), key = position)
+        # rows are ordered by (organization, asn), so the next ASN is the continuation token
+        if after:
+            number = int(after)
+            row = bisect.bisect_left(keys, number)
+            if row == len(keys) or keys[row] != number or not (org(row) or '').lower().startswith(prefix):
+                raise ValueError('after is not in this listing')
+            first = bisect.bisect_left(range(len(rows)), (org(row).lower(), number), key = position)
+        asns = []
+        following = None
+        for i in range(first, len(rows)):
+            if not position(i)[0].startswith(prefix):
+                break
+            if len(asns) == limit:
+                following = str(keys[rows[i]])
+                break
+            asns.append({'asn': keys[rows[i]], 'org': org(rows[i])})
+        return {'org': key, 'asns': asns, 'after': following, 'attribution': ATTRIBUTION}
+
+    if kind == 'asn':
+        value = int(key)
+    elif len(key) == 2 and key.isascii() and key.isalpha():
+        value = ord(key[0].upper()) << 8 | ord(key[1].upper())
+    else:
+        raise ValueError('expected a two-letter country code')
+
+    keys = index[kind+'_keys']
+    row = bisect.bisect_left(keys, value)
+    if row == len(keys) or keys[row] != value:
+        return None
+
+    v4 = range(index[kind+'_v4_offsets'][row], index[kind+'_v4_offsets'][row + 1])
+    v6 = range(index[kind+'_v6_offsets'][row], index[kind+'_v6_offsets'][row + 1])
+    v4_start = index[kind+'_v4_start']
+    v6_hi = index[kind+'_v6_hi']
+    v6_lo = index[kind+'_v6_lo']
+
+    if after:
+        address = ipaddress.ip_address(after)
+        if address.version == 4:
+            v4 = range(bisect.bisect_left(v4_start, int(address), v4.start, v4.stop), v4.stop)
+        else:
+            v4 = range(0)
+            v6 = range(bisect.bisect_left(range(v6.stop), int(address), v6.start, key = lambda i: v6_hi[i] << 64 | v6_lo[i]), v6.stop)
+
+    networks = []
+    following = None
+    for family, rows in ((4, v4), (6, v6)):
+        for i in rows:
+            if family == 4:
+                start = ipaddress.IPv4Address(v4_start[i])
+                prefixlen = index[kind+'_v4_prefix'][i]
+            else:
+                start = ipaddress.IPv6Address(v6_hi[i] << 64 | v6_lo[i])
+                prefixlen = index[kind+'_v6_prefix'][i]
+            if len(networks) == limit:
+                following = str(start)
+                break
+            networks.append({'cidr': str(start)+'/'+str(prefixlen)})
+        if following is not None:
+            break
+
+    msg = {'asn': value, 'org': string(index, index['asn_org'][row])} if kind == 'asn' else {'c_iso': key.upper()}
+    msg.update({'networks': networks, 'after': following, 'attribution': ATTRIBUTION})
+
+    return msg
+
+def expires(now):
+
+    # scheduled builds start WED and SAT at 09:00 UTC and finish within the hour
+    for days in range(8):
+        boundary = (now + datetime.timedelta(days = days)).replace(hour = 10, minute = 0, second = 0, microsecond = 0)
+        if boundary.weekday() in (2, 5) and boundary > now:
+            return int((boundary - now).total_seconds())
+
+def caching(now, fmt):
+
+    engine = os.environ.get('ENGINE', 'mmdb')
+    builds = []
+    for edition in ENGINES[engine]:
+        reader(edition)
+        builds.append(readers[edition]['build'])
+
+    return {
+        'Cache-Control': 'public, max-age='+str(expires(now)),
+        'ETag': '"'+'-'.join(str(build) for build in builds)+'-'+FORMATS.get(fmt, 'pretty').split('/')[-1]+'"',
+        'Last-Modified': email.utils.formatdate(max(builds), usegmt = True)
+    }
+
+def matches(header, tag):
+
+    for value in header.split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        if value == tag or value == '*':
+            return True
+
+    return False
+
+def negotiate(accept):
+
+    ranked = []
+    for position, part in enumerate(accept.split(',')):
+        media, *params = [item.strip() for item in part.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        ranked.append((-quality, position, media.lower()))
+
+    for quality, position, media in sorted(ranked):
+        if quality < 0 and media in FORMATS:
+            return media
+
+    return 'pretty'
+
+def pack(value, out):
+
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif 0 <= value <= 0xffffffff:
+            out.extend(b'\xce' + value.to_bytes(4, 'big'))
+        else:
+            out.extend(b'\xd3' + value.to_bytes(8, 'big', signed = True))
+    elif isinstance(value, float):
+        out.extend(b'\xcb' + struct.pack('>d', value))
+    elif isinstance(value, str):
+        data = value.encode()
+        if len(data) < 32:
+            out.append(0xa0 | len(data))
+        else:
+            out.extend(b'\xdb' + len(data).to_bytes(4, 'big'))
+        out.extend(data)
+    elif isinstance(value, list):
+        out.extend(b'\xdd' + len(value).to_bytes(4, 'big'))
+        for item in value:
+            pack(item, out)
+    elif isinstance(value, dict):
+        out.extend(b'\xdf' + len(value).to_bytes(4, 'big'))
+        for key, item in value.items():
+            pack(key, out)
+            pack(item, out)
+    else:
+        raise TypeError(value)
+
+    return out
+
+def serialize(msg, fmt):
+
+    if fmt == 'pretty':
+        return json.dumps(msg, indent = 4)
+
+    if isinstance(msg, dict):
+        msg = {key: value for key, value in msg.items() if key != 'attribution'}
+    elif isinstance(msg, list):
+        msg = [{key: value for key, value in item.items() if key != 'attribution'} for item in msg]
+
+    if fmt == 'application/json':
+        return json.dumps(msg, separators = (',', ':'))
+
+    if fmt == 'application/x-ndjson':
+        rows = msg if isinstance(msg, list) else [msg]
+        return ''.join(json.dumps(row, separators = (',', ':'))+'\n' for row in rows)
+
+    if fmt == 'text/csv':
+        if isinstance(msg, str):
+            return msg+'\n'
+        rows = msg if isinstance(msg, list) else [msg]
+        columns = list(dict.fromkeys(key for row in rows for key in row))
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames = columns, lineterminator = '\n')
+        writer.writeheader()
+        writer.writerows(rows)
+        return out.getvalue()
+
+    return base64.b64encode(pack(msg, bytearray())).decode()
+
+def respond(code, msg, headers, fmt):
+
+    headers = dict(headers)
+    headers['Content-Type'] = FORMATS.get(fmt, 'application/json')
+    headers['Vary'] = 'Accept'
+    headers['X-Attribution'] = ATTRIBUTION
+
+    begin = time.perf_counter()
+    response = {
+        'statusCode': code,
+        'headers': headers,
+        'body': serialize(msg, fmt)
+    }
+    clock('Serialization', begin)
+
+    if fmt in ('application/msgpack', 'application/x-msgpack'):
+        response['isBase64Encoded'] = True
+
+    return response
+
+def emit(event, response, elapsed):
+
+    engine = os.environ.get('ENGINE', 'mmdb')
+    builds = [readers[edition]['build'] for edition in ENGINES[engine] if edition in readers]
+    if builds:
+        metrics['DatabaseBuild'] = max(builds)
+    metrics['Duration'] = elapsed
+
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': 'GeoLite2',
+                'Dimensions': [['Engine']],
+                'Metrics': [{'Name': metric, 'Unit': UNITS[metric]} for metric in metrics]
+            }]
+        },
+        'Engine': engine,
+        'StatusCode': response['statusCode'],
+        **metrics
+    }))
+
+    metrics.clear()
+
+    if random.random() < float(os.environ.get('LOG_SAMPLE_RATE', '0.01')):
+        http = event.get('requestContext', {}).get('http', {})
+        print(json.dumps({
+            'method': http.get('method'),
+            'path': event.get('rawPath'),
+            'query': event.get('rawQueryString'),
+            'source': http.get('sourceIp'),
+            'agent': http.get('userAgent'),
+            'status': response['statusCode'],
+            'ms': round(elapsed, 3)
+        }))
 
 def handler(event, context):
 
-    print(event)
+    begin = time.perf_counter()
+    response = route(event)
+    emit(event, response, (time.perf_counter() - begin) * 1000)
+
+    return response
+
+def route(event):
+
+    fmt = negotiate(event.get('headers', {}).get('accept', ''))
+
+    if event.get('requestContext', {}).get('http', {}).get('method') == 'POST':
+
+        try:
+            body = event.get('body') or ''
+            if event.get('isBase64Encoded'):
+                body = base64.b64decode(body)
+            code = 200
+            msg = batch(body, selection(event.get('queryStringParameters') or {}))
+        except:
+            code = 400
+            msg = 'Send a JSON list of addresses'
+            pass
+
+        return respond(code, msg, {}, fmt)
+
+    try:
+        headers = caching(datetime.datetime.now(datetime.timezone.utc), fmt)
+    except:
+        headers = {}
+        pass
+
+    if headers and matches(event.get('headers', {}).get('if-none-match', ''), headers['ETag']):
+        return {
+            'statusCode': 304,
+            'headers': headers
+        }
+
+    try:
+        fields = selection(event.get('queryStringParameters') or {})
+    except ValueError:
+        return respond(400, 'Choose fields from '+', '.join(FIELDS), {}, fmt)
+
+    path = event.get('rawPath', '/')[1:]
+
+    if '/' in path:
+
+        query = event.get('queryStringParameters') or {}
+        kind, _, key = path.partition('/')
+        try:
+            if kind in ('asn', 'country', 'org'):
+                msg = reverse(kind, urllib.parse.unquote(key), query.get('after'), query.get('limit'))
+            else:
+                msg = enumerate_networks(path, query.get('after'), query.get('limit'), fields)
+        except ValueError:
+            return respond(400, 'Send a network such as 203.0.113.0/24, /asn/<number>, /country/<iso> or /org/<name>', {}, fmt)
+        except:
+            msg = None
+            pass
+
+        if msg is None:
+            return respond(404, 'Where the Internet Ends', {}, fmt)
+
+        headers = dict(headers)
+        if msg.get('after') is not None:
+            headers['X-Next-After'] = msg['after']
+        if fmt in ('application/x-ndjson', 'text/csv'):
+            msg = msg['asns' if kind == 'org' else 'networks']
+
+        return respond(200, msg, headers, fmt)
 
     try:
 
         ip = event['rawPath'][1:]
         iptype = ipaddress.ip_address(ip)
 
-        with geoip2.database.Reader('GeoLite2-City.mmdb') as reader:
-            response = reader.city(ip)
-            country_code = response.country.iso_code
-            country_name = response.country.name
-            state_code = response.subdivisions.most_specific.iso_code
-            state_name = response.subdivisions.most_specific.name
-            city_name = response.city.name
-            zip_code = response.postal.code
-            latitude = response.location.latitude
-            longitude = response.location.longitude
-            cidr = response.traits.network
-            desc = 'This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.'
-        with geoip2.database.Reader('GeoLite2-ASN.mmdb') as reader2:
-            response2 = reader2.asn(ip)
-            asn = response2.autonomous_system_number
-            org = response2.autonomous_system_organization
         code = 200
-        msg = {
-            'country':country_name,
-            'c_iso':country_code,
-            'state':state_name,
-            's_iso':state_code,
-            'city':city_name,
-            'zip':zip_code,
-            'latitude':latitude,
-            'longitude':longitude,
-            'cidr':str(cidr),
-            'asn':asn,
-            'org':org,
-            'attribution':desc
-        }
+        msg = lookup(ip, fields)
     except:
         code = 404
         msg = 'Where the Internet Ends'
         pass
 
-    return {
-        'statusCode': code,
-        'body': json.dumps(msg, indent = 4)
-    }
\ No newline at end of file
+    return respond(code, msg, headers, fmt)
+
+WARM = [ipaddress.ip_address(octet << 24 | 1) for octet in range(256)] + \
+    [ipaddress.ip_address((0x2000 + block * 0x80) << 112 | 1) for block in range(64)]
+
+def warm(edition):
+
+    handle = reader(edition)
+
+    for address in WARM:
+        try:
+            if edition == 'index':
+                index_row(handle, address)
+            elif edition in ('merged', 'city_raw', 'asn_raw', 'country_raw'):
+                handle.get(address)
+            elif edition == 'city':
+                handle.city(address)
+            elif edition == 'country':
+                handle.country(address)
+            else:
+                handle.asn(address)
+        except geoip2.errors.AddressNotFoundError:
+            pass
+
+def init():
+
+    imported = time.perf_counter()
+    engine = os.environ.get('ENGINE', 'mmdb')
+    tier = TIERS.get('mmdb' if engine == 'index' else engine)
+    timings = {'engine': engine, 'import_ms': round((imported - STARTED) * 1000, 3)}
+
+    try:
+        for edition in ENGINES[engine]:
+            reader(edition)
+        if os.path.exists(located('hot')):
+            reader('hot')
+        if tier is not None and os.path.exists(located(tier)):
+            reader(tier)
+        opened = time.perf_counter()
+        timings['open_ms'] = round((opened - imported) * 1000, 3)
+        if os.environ.get('WARM_UP', 'false') == 'true':
+            for edition in ENGINES[engine]:
+                warm(edition)
+            if tier in readers:
+                warm(tier)
+            timings['warm_ms'] = round((time.perf_counter() - opened) * 1000, 3)
+    except:
+        timings['error'] = 'databases not available during init'
+        pass
+
+    print(json.dumps({'init': timings}))
+
+    metrics.clear()
+
+init()
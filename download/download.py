@@ -1,15 +1,956 @@
+import array
 import boto3
+import boto3.s3.transfer
+import botocore.exceptions
+import collections
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
+import ipaddress
 import json
+import math
+import maxminddb
 import os
+import random
 import requests
+import resource
+import shutil
+import struct
+import sys
 import tarfile
+import time
+import urllib.parse
 import zipfile
 
+CHUNK = 1024 * 1024
+
+TRANSFER = boto3.s3.transfer.TransferConfig(
+    multipart_threshold = 16 * CHUNK,
+    multipart_chunksize = 16 * CHUNK,
+    max_concurrency = 8,
+    io_chunksize = CHUNK
+)
+
+PROFILES = {
+    'maximum': {
+        '': (zipfile.ZIP_DEFLATED, 9)
+    },
+    'fast': {
+        '.mmdb': (zipfile.ZIP_DEFLATED, 1),
+        '.bin': (zipfile.ZIP_DEFLATED, 1),
+        '': (zipfile.ZIP_DEFLATED, 9)
+    },
+    'stored': {
+        '.mmdb': (zipfile.ZIP_STORED, None),
+        '.bin': (zipfile.ZIP_STORED, None),
+        '': (zipfile.ZIP_DEFLATED, 9)
+    }
+}
+
+EDITIONS = [
+    'GeoLite2-City',
+    'GeoLite2-ASN',
+    'GeoLite2-Country'
+]
+
+def networks(path):
+
+    with maxminddb.open_database(path) as reader:
+        for network, record in reader:
+            yield (
+                network.version,
+                int(network.network_address),
+                int(network.broadcast_address),
+                network.prefixlen,
+                record
+            )
+
+def join(city, asn):
+
+    a = next(city, None)
+    b = next(asn, None)
+
+    while a is not None and b is not None:
+        if (a[0], a[2]) < (b[0], b[1]):
+            a = next(city, None)
+        elif (b[0], b[2]) < (a[0], a[1]):
+            b = next(asn, None)
+        else:
+            yield a[0], max(a[1], b[1]), min(a[2], b[2]), a, b
+            if a[2] < b[2]:
+                a = next(city, None)
+            elif b[2] < a[2]:
+                b = next(asn, None)
+            else:
+                a = next(city, None)
+                b = next(asn, None)
+
+def outer(city, asn):
+
+    # positions carry the IP version above the address so both families sort in one space
+    def edge(item):
+        return item[0] << 128 | item[1], item[0] << 128 | item[2]
+
+    a = next(city, None)
+    b = next(asn, None)
+    a_start, a_end = edge(a) if a else (None, None)
+    b_start, b_end = edge(b) if b else (None, None)
+
+    while a is not None or b is not None:
+        start = min(position for position in (a_start, b_start) if position is not None)
+        in_a = a is not None and a_start <= start
+        in_b = b is not None and b_start <= start
+        ends = []
+        if a is not None:
+            ends.append(a_end if in_a else a_start - 1)
+        if b is not None:
+            ends.append(b_end if in_b else b_start - 1)
+        end = min(ends)
+
+        yield start >> 128, start & (1 << 128) - 1, end & (1 << 128) - 1, a if in_a else None, b if in_b else None
+
+        if in_a:
+            if end == a_end:
+                a = next(city, None)
+                a_start, a_end = edge(a) if a else (None, None)
+            else:
+                a_start = end + 1
+        if in_b:
+            if end == b_end:
+                b = next(asn, None)
+                b_start, b_end = edge(b) if b else (None, None)
+            else:
+                b_start = end + 1
+
+def fields(record):
+
+    if record is None:
+        return None
+
+    if 'autonomous_system_number' in record:
+        return {
+            'asn': record.get('autonomous_system_number'),
+            'org': record.get('autonomous_system_organization')
+        }
+
+    subdivisions = record.get('subdivisions') or [{}]
+    location = record.get('location', {})
+
+    return {
+        'c_iso': record.get('country', {}).get('iso_code'),
+        's_iso': subdivisions[-1].get('iso_code'),
+        'city': name(record.get('city')),
+        'zip': record.get('postal', {}).get('code'),
+        'latitude': location.get('latitude'),
+        'longitude': location.get('longitude')
+    }
+
+def delta(old, new):
+
+    a = next(old, None)
+    b = next(new, None)
+
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[:3] < b[:3]):
+            yield 'removed', a, None
+            a = next(old, None)
+        elif a is None or b[:3] < a[:3]:
+            yield 'added', None, b
+            b = next(new, None)
+        else:
+            if fields(a[4]) != fields(b[4]):
+                yield 'changed', a, b
+            a = next(old, None)
+            b = next(new, None)
+
+def write_delta(pairs, path):
+
+    stats = {}
+
+    with gzip.open(path, 'wt', compresslevel = 9) as f:
+        for edition, older, newer in pairs:
+            counts = {'added': 0, 'removed': 0, 'changed': 0}
+            with maxminddb.open_database(older) as reader:
+                before = reader.metadata().build_epoch
+            with maxminddb.open_database(newer) as reader:
+                after = reader.metadata().build_epoch
+            f.write(json.dumps({'edition': edition, 'from': before, 'to': after}, separators = (',', ':'))+'\n')
+            for op, a, b in delta(networks(older), networks(newer)):
+                counts[op] += 1
+                row = a or b
+                f.write(json.dumps({
+                    'edition': edition,
+                    'op': op,
+                    'network': str(ipaddress.ip_network(((ipaddress.IPv4Address if row[0] == 4 else ipaddress.IPv6Address)(row[1]), row[3]))),
+                    'old': fields(a[4]) if a else None,
+                    'new': fields(b[4]) if b else None
+                }, separators = (',', ':'))+'\n')
+            stats[edition] = counts
+
+    stats['size'] = os.path.getsize(path)
+    print(json.dumps({'delta': stats, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024}))
+
+    return stats
+
+def name(record):
+
+    return record.get('names', {}).get('en') if record else None
+
+def build_index(city, asn, path):
+
+    strings = {None: 0}
+    blob = bytearray()
+    offsets = array.array('I', [0, 0])
+
+    def intern(value):
+        if value not in strings:
+            strings[value] = len(offsets) - 1
+            blob.extend(value.encode())
+            offsets.append(len(blob))
+        return strings[value]
+
+    cities = {}
+    asns = {}
+
+    sections = {
+        'city_country': array.array('I'),
+        'city_c_iso': array.array('I'),
+        'city_state': array.array('I'),
+        'city_s_iso': array.array('I'),
+        'city_city': array.array('I'),
+        'city_zip': array.array('I'),
+        'city_latitude': array.array('d'),
+        'city_longitude': array.array('d'),
+        'asn_asn': array.array('I'),
+        'asn_org': array.array('I'),
+        'v4_start': array.array('I'),
+        'v4_end': array.array('I'),
+        'v4_city': array.array('I'),
+        'v4_asn': array.array('I'),
+        'v4_prefix': array.array('B'),
+        'v6_start_hi': array.array('Q'),
+        'v6_start_lo': array.array('Q'),
+        'v6_end_hi': array.array('Q'),
+        'v6_end_lo': array.array('Q'),
+        'v6_city': array.array('I'),
+        'v6_asn': array.array('I'),
+        'v6_prefix': array.array('B')
+    }
+
+    for version, start, end, a, b in join(networks(city), networks(asn)):
+
+        record = a[4]
+        subdivisions = record.get('subdivisions') or [{}]
+        location = record.get('location', {})
+        latitude = location.get('latitude')
+        longitude = location.get('longitude')
+        key = (
+            intern(name(record.get('country'))),
+            intern(record.get('country', {}).get('iso_code')),
+            intern(name(subdivisions[-1])),
+            intern(subdivisions[-1].get('iso_code')),
+            intern(name(record.get('city'))),
+            intern(record.get('postal', {}).get('code')),
+            math.nan if latitude is None else latitude,
+            math.nan if longitude is None else longitude
+        )
+        if key not in cities:
+            cities[key] = len(cities)
+            for column, value in zip(['city_country', 'city_c_iso', 'city_state', 'city_s_iso', 'city_city', 'city_zip', 'city_latitude', 'city_longitude'], key):
+                sections[column].append(value)
+
+        record = b[4]
+        key2 = (record.get('autonomous_system_number') or 0, intern(record.get('autonomous_system_organization')))
+        if key2 not in asns:
+            asns[key2] = len(asns)
+            sections['asn_asn'].append(key2[0])
+            sections['asn_org'].append(key2[1])
+
+        if version == 4:
+            sections['v4_start'].append(start)
+            sections['v4_end'].append(end)
+            sections['v4_city'].append(cities[key])
+            sections['v4_asn'].append(asns[key2])
+            sections['v4_prefix'].append(a[3])
+        else:
+            sections['v6_start_hi'].append(start >> 64)
+            sections['v6_start_lo'].append(start & 0xFFFFFFFFFFFFFFFF)
+            sections['v6_end_hi'].append(end >> 64)
+            sections['v6_end_lo'].append(end & 0xFFFFFFFFFFFFFFFF)
+            sections['v6_city'].append(cities[key])
+            sections['v6_asn'].append(asns[key2])
+            sections['v6_prefix'].append(a[3])
+
+    sections['str_offsets'] = offsets
+    sections['str_blob'] = array.array('B', blob)
+
+    with maxminddb.open_database(city) as reader:
+        build = reader.metadata().build_epoch
+
+    write_sections(path, b'GEOIDX01', build, sections)
+
+def build_reverse(city, asn, path):
+
+    groups = {'asn': {}, 'country': {}}
+    orgs = {}
+
+    def add(kind, key, version, start, prefixlen):
+        if key not in groups[kind]:
+            groups[kind][key] = (array.array('I'), array.array('B'), array.array('Q'), array.array('Q'), array.array('B'))
+        v4_start, v4_prefix, v6_hi, v6_lo, v6_prefix = groups[kind][key]
+        if version == 4:
+            v4_start.append(start)
+            v4_prefix.append(prefixlen)
+        else:
+            v6_hi.append(start >> 64)
+            v6_lo.append(start & 0xFFFFFFFFFFFFFFFF)
+            v6_prefix.append(prefixlen)
+
+    for version, start, end, prefixlen, record in networks(asn):
+        number = record.get('autonomous_system_number')
+        if number:
+            add('asn', number, version, start, prefixlen)
+            orgs.setdefault(number, record.get('autonomous_system_organization'))
+
+    for version, start, end, prefixlen, record in networks(city):
+        iso = record.get('country', {}).get('iso_code')
+        if iso:
+            add('country', ord(iso[0]) << 8 | ord(iso[1]), version, start, prefixlen)
+
+    strings = {None: 0}
+    blob = bytearray()
+    offsets = array.array('I', [0, 0])
+
+    def intern(value):
+        if value not in strings:
+            strings[value] = len(offsets) - 1
+            blob.extend(value.encode())
+            offsets.append(len(blob))
+        return strings[value]
+
+    sections = {}
+    for kind, keys in groups.items():
+        sections[kind+'_keys'] = array.array('I' if kind == 'asn' else 'H', sorted(keys))
+        sections[kind+'_v4_offsets'] = array.array('I', [0])
+        sections[kind+'_v6_offsets'] = array.array('I', [0])
+        columns = [kind+'_v4_start', kind+'_v4_prefix', kind+'_v6_hi', kind+'_v6_lo', kind+'_v6_prefix']
+        for column, typecode in zip(columns, 'IBQQB'):
+            sections[column] = array.array(typecode)
+        for key in sections[kind+'_keys']:
+            for column, values in zip(columns, groups[kind].pop(key)):
+                sections[column].extend(values)
+            sections[kind+'_v4_offsets'].append(len(sections[kind+'_v4_start']))
+            sections[kind+'_v6_offsets'].append(len(sections[kind+'_v6_hi']))
+
+    keys = sections['asn_keys']
+    sections['asn_org'] = array.array('I', [intern(orgs[number]) for number in keys])
+    sections['org_rows'] = array.array('I', sorted((row for row in range(len(keys)) if orgs[keys[row]]), key = lambda row: (orgs[keys[row]].lower(), keys[row])))
+    sections['str_offsets'] = offsets
+    sections['str_blob'] = array.array('B', blob)
+
+    with maxminddb.open_database(city) as reader:
+        build = reader.metadata().build_epoch
+
+    write_sections(path, b'GEOREV01', build, sections)
+
+    stats = {
+        'asns': len(sections['asn_keys']),
+        'countries': len(sections['country_keys']),
+        'size': os.path.getsize(path),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    }
+    print(json.dumps({'reverse': stats}))
+
+    return stats
+
+def write_sections(path, magic, build, sections):
+
+    header = {'build': build, 'sections': {}}
+    offset = 0
+    for column, values in sections.items():
+        header['sections'][column] = [values.typecode, offset, len(values)]
+        offset += (len(values) * values.itemsize + 7) // 8 * 8
+    header = json.dumps(header).encode()
+
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        f.write(bytes(-(16 + len(header)) % 8))
+        for values in sections.values():
+            values.tofile(f)
+            f.write(bytes(-(len(values) * values.itemsize) % 8))
+
+def benchmark(path, samples = 10000):
+
+    sys.path.insert(0, path)
+    os.chdir(path)
+    import search
+
+    # call both engines directly so neither the hot table nor the cache answers for them
+    index = search.reader('index')
+    handles = [search.reader(edition) for edition in search.ENGINES['mmdb']]
+    v4 = len(index['v4_start'])
+    v6 = len(index['v6_start_hi'])
+
+    ips = []
+    for _ in range(samples if v4 or v6 else 0):
+        if v4 and (not v6 or random.random() < 0.5):
+            row = random.randrange(v4)
+            ips.append(str(ipaddress.IPv4Address(random.randint(index['v4_start'][row], index['v4_end'][row]))))
+        else:
+            row = random.randrange(v6)
+            low = index['v6_start_hi'][row] << 64 | index['v6_start_lo'][row]
+            high = index['v6_end_hi'][row] << 64 | index['v6_end_lo'][row]
+            ips.append(str(ipaddress.IPv6Address(random.randint(low, high))))
+
+    results = {'samples': len(ips)}
+    answers = {}
+    engines = {
+        'mmdb': lambda ip: search.model_lookup(handles, ip, True, True)[0],
+        'index': lambda ip: search.index_lookup(index, ipaddress.ip_address(ip))[0]
+    }
+    for engine, lookup in engines.items():
+        answers[engine] = []
+        begin = time.perf_counter()
+        for ip in ips:
+            answers[engine].append(lookup(ip))
+        results[engine] = round((time.perf_counter() - begin) / max(len(ips), 1) * 1000000, 2)
+    results['identical'] = answers['mmdb'] == answers['index']
+
+    print(json.dumps({'benchmark': results}))
+
+    return results['identical']
+
+def log_counts(s3_client, bucket, key, bound):
+
+    counts = collections.Counter()
+    names = []
+
+    body = s3_client.get_object(Bucket = bucket, Key = key)['Body']
+    with gzip.open(body, 'rt') as f:
+        for line in f:
+            if line.startswith('#Fields:'):
+                names = line[8:].split()
+                continue
+            if line.startswith('#'):
+                continue
+            row = dict(zip(names, line.rstrip('\n').split('\t')))
+            if row.get('cs-method') == 'GET' and row.get('sc-status') in ('200', '304'):
+                counts[urllib.parse.unquote(row.get('cs-uri-stem', '/'))[1:]] += 1
+
+    return collections.Counter(dict(counts.most_common(bound)))
+
+def log_keys(s3_client, bucket, since):
+
+    # standard logs are named <prefix><distribution>.YYYY-MM-DD-HH.<unique>.gz, so each
+    # distribution's objects are listed in date order and can start at the first recent hour
+    keys = []
+    after = ''
+    paginator = s3_client.get_paginator('list_objects_v2')
+    while True:
+        first = s3_client.list_objects_v2(Bucket = bucket, StartAfter = after, MaxKeys = 1).get('Contents')
+        if not first:
+            break
+        head = first[0]['Key'].rsplit('.', 3)[0]
+        for page in paginator.paginate(Bucket = bucket, Prefix = head+'.', StartAfter = head+'.'+since.strftime('%Y-%m-%d-%H')):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith('.gz'):
+                    keys.append(item['Key'])
+        after = head+'/'
+
+    return keys
+
+def mine_logs(s3_client, bucket, days, limit):
+
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days = days)
+    keys = log_keys(s3_client, bucket, since)
+
+    # keep the heaviest addresses per file and overall, trimming back whenever the total doubles
+    bound = limit * 10
+    counts = collections.Counter()
+    total = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = 8) as pool:
+        for result in pool.map(lambda key: log_counts(s3_client, bucket, key, bound), keys):
+            total += sum(result.values())
+            counts.update(result)
+            if len(counts) > 2 * bound:
+                counts = collections.Counter(dict(counts.most_common(bound)))
+
+    print(json.dumps({'logs': {'objects': len(keys), 'requests': total, 'addresses': len(counts)}}))
+
+    return counts
+
+def build_hot(path, counts, limit, output):
+
+    sys.path.insert(0, path)
+    os.chdir(path)
+    os.environ['ENGINE'] = 'raw'
+    os.environ['CACHE_SIZE'] = '0'
+    import search
+
+    handles = [search.reader(edition) for edition in search.ENGINES['raw']]
+
+    hits = collections.Counter()
+    answers = {}
+    for ip, count in counts.items():
+        try:
+            address = ipaddress.ip_address(ip)
+            msg, network = search.raw_lookup(handles, address, True, True)
+        except (ValueError, search.geoip2.errors.AddressNotFoundError):
+            continue
+        hits[network] += count
+        answers[network] = msg
+
+    sections = {
+        'v4_start': array.array('I'),
+        'v4_end': array.array('I'),
+        'v4_offset': array.array('I'),
+        'v6_start_hi': array.array('Q'),
+        'v6_start_lo': array.array('Q'),
+        'v6_end_hi': array.array('Q'),
+        'v6_end_lo': array.array('Q'),
+        'v6_offset': array.array('I'),
+        'blob': array.array('B')
+    }
+
+    top = [network for network, count in hits.most_common(limit)]
+    top.sort(key = lambda network: (network.version, network))
+
+    # both families share the blob, so each offsets array starts where the previous family ended
+    for version in (4, 6):
+        family = 'v'+str(version)
+        sections[family+'_offset'].append(len(sections['blob']))
+        for network in top:
+            if network.version != version:
+                continue
+            msg = {key: value for key, value in answers[network].items() if key != 'attribution'}
+            sections['blob'].frombytes(json.dumps(msg, separators = (',', ':')).encode())
+            start = int(network.network_address)
+            end = int(network.broadcast_address)
+            if version == 4:
+                sections['v4_start'].append(start)
+                sections['v4_end'].append(end)
+            else:
+                sections['v6_start_hi'].append(start >> 64)
+                sections['v6_start_lo'].append(start & 0xFFFFFFFFFFFFFFFF)
+                sections['v6_end_hi'].append(end >> 64)
+                sections['v6_end_lo'].append(end & 0xFFFFFFFFFFFFFFFF)
+            sections[family+'_offset'].append(len(sections['blob']))
+
+    write_sections(output, b'GEOHOT01', search.readers['city_raw']['build'], sections)
+
+    hot = search.open_index(output)
+    mismatches = 0
+    for network in top:
+        for address in (network.network_address, network.broadcast_address):
+            if search.hot_lookup(hot, address) != answers[network]:
+                mismatches += 1
+
+    stats = {
+        'networks': len(top),
+        'v4': len(sections['v4_start']),
+        'v6': len(sections['v6_start_hi']),
+        'coverage': round(sum(hits[network] for network in top) / max(sum(counts.values()), 1), 4),
+        'size': os.path.getsize(output),
+        'identical': mismatches == 0
+    }
+    print(json.dumps({'hot': stats}))
+
+    return stats
+
+def encode(value, data, strings):
+
+    if isinstance(value, str):
+        if value in strings:
+            data.extend(b'\x38' + strings[value].to_bytes(4, 'big'))
+            return
+        if len(value) > 4:
+            strings[value] = len(data)
+        value = value.encode()
+        control(2, len(value), data)
+        data.extend(value)
+    elif isinstance(value, dict):
+        control(7, len(value), data)
+        for key, item in value.items():
+            encode(key, data, strings)
+            encode(item, data, strings)
+    elif isinstance(value, list):
+        control(11, len(value), data)
+        for item in value:
+            encode(item, data, strings)
+    elif isinstance(value, bool):
+        control(14, int(value), data)
+    elif isinstance(value, float):
+        control(3, 8, data)
+        data.extend(struct.pack('>d', value))
+    elif isinstance(value, int):
+        size = (value.bit_length() + 7) // 8
+        encode((5 if size <= 2 else 6 if size <= 4 else 9, value), data, strings)
+    elif isinstance(value, tuple):
+        kind, number = value
+        size = (number.bit_length() + 7) // 8
+        control(kind, size, data)
+        data.extend(number.to_bytes(size, 'big'))
+    else:
+        raise TypeError(value)
+
+def control(kind, size, data):
+
+    if size < 29:
+        extra = b''
+    elif size < 285:
+        extra = bytes([size - 29])
+        size = 29
+    elif size < 65821:
+        extra = (size - 285).to_bytes(2, 'big')
+        size = 30
+    else:
+        extra = (size - 65821).to_bytes(3, 'big')
+        size = 31
+
+    if kind <= 7:
+        data.append(kind << 5 | size)
+    else:
+        data.extend(bytes([size, kind - 7]))
+    data.extend(extra)
+
+def write_mmdb(path, records, database_type, build_epoch):
+
+    left = array.array('I', [0])
+    right = array.array('I', [0])
+    data = bytearray()
+    strings = {}
+    offsets = {}
+    trail = [0]
+    previous = None
+
+    def child(node, bit):
+        side = right if bit else left
+        if side[node] == 0:
+            side[node] = len(left)
+            left.append(0)
+            right.append(0)
+        return side[node]
+
+    for version, start, prefixlen, record in records:
+
+        depth = prefixlen + 96 if version == 4 else prefixlen
+
+        encoded = bytearray()
+        encode(record, encoded, {})
+        digest = hashlib.sha1(encoded).digest()
+        if digest not in offsets:
+            offsets[digest] = len(data)
+            encode(record, data, strings)
+
+        common = 0 if previous is None else 128 - (start ^ previous).bit_length()
+        common = min(common, len(trail) - 1, depth - 1)
+        del trail[common + 1:]
+        node = trail[common]
+        for i in range(common, depth - 1):
+            node = child(node, start >> 127 - i & 1)
+            trail.append(node)
+
+        side = right if start >> 128 - depth & 1 else left
+        side[node] = 0x80000000 | offsets[digest]
+        previous = start
+
+    ipv4 = 0
+    for i in range(96):
+        ipv4 = left[ipv4]
+        if ipv4 == 0 or ipv4 & 0x80000000:
+            break
+
+    if ipv4 and not ipv4 & 0x80000000:
+        for alias, depth in ((0xFFFF << 32, 96), (0x2002 << 112, 16)):
+            node = 0
+            for i in range(depth - 1):
+                node = child(node, alias >> 127 - i & 1)
+            side = right if alias >> 128 - depth & 1 else left
+            side[node] = ipv4
+
+    count = len(left)
+    size = count + 16 + len(data)
+    bits = 24 if size < 1 << 24 else 28 if size < 1 << 28 else 32
+
+    def value(pointer):
+        if pointer == 0:
+            return count
+        if pointer & 0x80000000:
+            return count + 16 + (pointer & 0x7FFFFFFF)
+        return pointer
+
+    metadata = bytearray()
+    encode({
+        'binary_format_major_version': (5, 2),
+        'binary_format_minor_version': (5, 0),
+        'build_epoch': (9, build_epoch),
+        'database_type': database_type,
+        'description': {'en': database_type},
+        'ip_version': (5, 6),
+        'languages': ['en'],
+        'node_count': (6, count),
+        'record_size': (5, bits)
+    }, metadata, {})
+
+    with open(path, 'wb') as f:
+        tree = bytearray()
+        for node in range(count):
+            l = value(left[node])
+            r = value(right[node])
+            if bits == 24:
+                tree.extend(l.to_bytes(3, 'big') + r.to_bytes(3, 'big'))
+            elif bits == 28:
+                tree.extend((l & 0xFFFFFF).to_bytes(3, 'big') + bytes([(l >> 24) << 4 | r >> 24]) + (r & 0xFFFFFF).to_bytes(3, 'big'))
+            else:
+                tree.extend(l.to_bytes(4, 'big') + r.to_bytes(4, 'big'))
+            if len(tree) > 1 << 20:
+                f.write(tree)
+                tree.clear()
+        f.write(tree)
+        f.write(bytes(16))
+        f.write(data)
+        f.write(b'\xab\xcd\xefMaxMind.com')
+        f.write(metadata)
+
+def trim(record):
+
+    trimmed = {}
+    if record.get('iso_code') is not None:
+        trimmed['iso_code'] = record['iso_code']
+    if name(record) is not None:
+        trimmed['names'] = {'en': name(record)}
+    return trimmed
+
+def merged_records(city, asn):
+
+    kind = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+
+    for version, start, end, a, b in outer(networks(city), networks(asn)):
+
+        merged = {}
+        traits = {}
+
+        if a is not None:
+            record = a[4]
+            # country marks the City section, so it is kept even when the record has none
+            merged['country'] = trim(record.get('country', {}))
+            if record.get('subdivisions'):
+                merged['subdivisions'] = [trim(record['subdivisions'][-1])]
+            if record.get('city'):
+                merged['city'] = trim(record['city'])
+            if record.get('postal', {}).get('code') is not None:
+                merged['postal'] = {'code': record['postal']['code']}
+            location = {key: value for key, value in record.get('location', {}).items() if key in ('latitude', 'longitude')}
+            if location:
+                merged['location'] = location
+
+        if b is not None:
+            traits = {key: value for key, value in b[4].items() if key in ('autonomous_system_number', 'autonomous_system_organization')}
+
+        # a piece that only one database covers can span several CIDRs
+        for piece in ipaddress.summarize_address_range(kind[version](start), kind[version](end)):
+            record = dict(merged)
+            if a is not None and piece.prefixlen != a[3]:
+                record['traits'] = dict(traits, city_prefix_delta = piece.prefixlen - a[3])
+            elif traits:
+                record['traits'] = traits
+            yield version, int(piece.network_address), piece.prefixlen, record
+
+def build_merged(city, asn, path):
+
+    with maxminddb.open_database(city) as reader:
+        build = reader.metadata().build_epoch
+
+    write_mmdb(path, merged_records(city, asn), 'GeoLite2-City-ASN', build)
+
+class Digest:
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size = -1):
+        data = self.raw.read(size)
+        self.sha256.update(data)
+        return data
+
+def fetch(edition, auth, previous):
+
+    url = 'https://download.maxmind.com/geoip/databases/'+edition+'/download'
+    path = '/tmp/'+edition+'.mmdb'
+
+    headers = {}
+    if previous.get('last-modified'):
+        headers['If-Modified-Since'] = previous['last-modified']
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+
+    with requests.get(url, params = {'suffix': 'tar.gz'}, auth = auth, headers = headers, stream = True) as response:
+        if response.status_code == 304:
+            print(json.dumps({'edition': edition, 'status': 'not modified'}))
+            return path, None
+        response.raise_for_status()
+        digest = Digest(response.raw)
+        with tarfile.open(fileobj = digest, mode = 'r|gz') as tar:
+            for member in tar:
+                if os.path.splitext(member.name)[1] == '.mmdb':
+                    r = tar.extractfile(member)
+                    with open(path, 'wb') as w:
+                        shutil.copyfileobj(r, w, CHUNK)
+                    r.close()
+        while digest.read(CHUNK):
+            pass
+        state = {
+            'last-modified': response.headers.get('Last-Modified', ''),
+            'etag': response.headers.get('ETag', ''),
+            'sha256': digest.sha256.hexdigest()
+        }
+
+    checksum = requests.get(url, params = {'suffix': 'tar.gz.sha256'}, auth = auth)
+    checksum.raise_for_status()
+    if checksum.text.split()[0] != state['sha256']:
+        raise ValueError(edition+' sha256 does not match the published checksum')
+
+    print(json.dumps({'edition': edition, 'sha256': state['sha256'], 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024}))
+
+    return path, state
+
+def process(edition, auth, s3_client, keep):
+
+    older = '/tmp/'+edition+'.previous.mmdb'
+    if os.path.exists(older):
+        os.remove(older)
+
+    try:
+        previous = s3_client.head_object(Bucket = os.environ['S3_BUCKET'], Key = edition+'.mmdb')['Metadata']
+        exists = True
+    except botocore.exceptions.ClientError:
+        previous = {}
+        exists = False
+
+    path, state = fetch(edition, auth, previous)
+    if state is None or state['sha256'] == previous.get('sha256'):
+        return path, None
+
+    if exists and keep:
+        s3_client.download_file(os.environ['S3_BUCKET'], edition+'.mmdb', older, Config = TRANSFER)
+
+    return path, state
+
+def store(edition, path, state, s3_client):
+
+    # the copy and its change-detection metadata only move once the build is deployed
+    s3_client.upload_file(path, os.environ['S3_BUCKET'], edition+'.mmdb', ExtraArgs = {'Metadata': state}, Config = TRANSFER)
+
+def policy(profile, name):
+
+    rules = PROFILES[profile]
+
+    return rules.get(os.path.splitext(name)[1], rules[''])
+
+def package(path, entries, profile):
+
+    begin = time.perf_counter()
+
+    with zipfile.ZipFile(path, 'w') as zipf:
+        for fullpath, name in entries:
+            compression, level = policy(profile, name)
+            zipf.write(fullpath, name, compress_type = compression, compresslevel = level)
+
+    return {
+        'profile': profile,
+        'size': os.path.getsize(path),
+        'build': round(time.perf_counter() - begin, 3)
+    }
+
+def measure(path, directory, probe = '1.1.1.1'):
+
+    shutil.rmtree(directory, ignore_errors = True)
+
+    begin = time.perf_counter()
+    with zipfile.ZipFile(path) as zipf:
+        zipf.extractall(directory)
+    extract = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.mmdb'):
+            with maxminddb.open_database(os.path.join(directory, name), maxminddb.MODE_MMAP) as reader:
+                reader.get(probe)
+    lookup = time.perf_counter() - begin
+
+    shutil.rmtree(directory, ignore_errors = True)
+
+    return {
+        'extract': round(extract, 3),
+        'first_lookup': round(lookup, 6)
+    }
+
+def point(client, ssm, arn):
+
+    name = arn.rsplit(':', 1)[0]
+    config = client.get_function_configuration(FunctionName = os.environ['LAMBDA_FUNCTION'])
+    layers = [layer['Arn'] for layer in config.get('Layers', []) if layer['Arn'].rsplit(':', 1)[0] != name]
+
+    client.update_function_configuration(
+        FunctionName = os.environ['LAMBDA_FUNCTION'],
+        Layers = layers + [arn]
+    )
+    client.get_waiter('function_updated_v2').wait(FunctionName = os.environ['LAMBDA_FUNCTION'])
+
+    ssm.put_parameter(
+        Name = os.environ['SSM_PARAMETER_LAYER'],
+        Value = arn,
+        Type = 'String',
+        Overwrite = True
+    )
+
+    print(json.dumps({'layer': arn}))
+
+def invalidate():
+
+    # answers are cached until the next build boundary, so an off-schedule deploy has to clear them
+    cloudfront = boto3.client('cloudfront')
+    response = cloudfront.create_invalidation(
+        DistributionId = os.environ['DISTRIBUTION_ID'],
+        InvalidationBatch = {
+            'Paths': {'Quantity': 1, 'Items': ['/*']},
+            'CallerReference': str(time.time_ns())
+        }
+    )
+
+    print(json.dumps({'invalidation': response['Invalidation']['Id']}))
+
+def prune(client, keep):
+
+    versions = []
+    paginator = client.get_paginator('list_layer_versions')
+    for page in paginator.paginate(LayerName = os.environ['LAYER_NAME']):
+        versions.extend(item['Version'] for item in page['LayerVersions'])
+
+    for version in sorted(versions)[:-keep]:
+        client.delete_layer_version(LayerName = os.environ['LAYER_NAME'], VersionNumber = version)
+
 def handler(event, context):
 
     ssm = boto3.client('ssm')
 
+    if event.get('layer_version'):
+        client = boto3.client('lambda')
+        arn = client.get_layer_version(
+            LayerName = os.environ['LAYER_NAME'],
+            VersionNumber = int(event['layer_version'])
+        )['LayerVersionArn']
+        point(client, ssm, arn)
+        invalidate()
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Search now uses '+arn)
+        }
+
     account = ssm.get_parameter(
         Name = os.environ['SSM_PARAMETER_ACCT'], 
         WithDecryption = True
@@ -20,79 +961,135 @@ def handler(event, context):
         WithDecryption = True
     )
 
-    url = 'https://download.maxmind.com/geoip/databases/GeoLite2-City/download?suffix=tar.gz'
-    response = requests.get(url, auth=(account['Parameter']['Value'], secret['Parameter']['Value']))
-    with open('/tmp/maxmind.tar.gz', 'wb') as f:
-        f.write(response.content)
-    f.close()
-
-    with open('/tmp/GeoLite2-City.mmdb', 'wb') as w:
-        with tarfile.open('/tmp/maxmind.tar.gz', 'r:gz') as tar:
-            for member in tar.getmembers():
-                if os.path.splitext(member.name)[1] == '.mmdb':
-                    r = tar.extractfile(member)
-                    if r is not None:
-                        content = r.read()
-                    r.close
-                    w.write(content)
-        tar.close()
-    w.close()
+    auth = (account['Parameter']['Value'], secret['Parameter']['Value'])
 
     s3_client = boto3.client('s3')
 
-    response = s3_client.upload_file('/tmp/GeoLite2-City.mmdb',os.environ['S3_BUCKET'],'GeoLite2-City.mmdb')
+    changes = os.environ.get('BUILD_DELTA', 'false') == 'true'
 
-    url = 'https://download.maxmind.com/geoip/databases/GeoLite2-ASN/download?suffix=tar.gz'
-    response = requests.get(url, auth=(account['Parameter']['Value'], secret['Parameter']['Value']))
-    with open('/tmp/maxmind2.tar.gz', 'wb') as f:
-        f.write(response.content)
-    f.close()
+    with concurrent.futures.ThreadPoolExecutor(max_workers = len(EDITIONS)) as pool:
+        results = list(pool.map(lambda edition: process(edition, auth, s3_client, changes), EDITIONS))
 
-    with open('/tmp/GeoLite2-ASN.mmdb', 'wb') as w:
-        with tarfile.open('/tmp/maxmind2.tar.gz', 'r:gz') as tar:
-            for member in tar.getmembers():
-                if os.path.splitext(member.name)[1] == '.mmdb':
-                    r = tar.extractfile(member)
-                    if r is not None:
-                        content = r.read()
-                    r.close
-                    w.write(content)
-        tar.close()
-    w.close()
+    if not any(state for path, state in results) and not event.get('force'):
+        return {
+            'statusCode': 200,
+            'body': json.dumps('No GeoLite2 updates since the last build.')
+        }
 
-    response = s3_client.upload_file('/tmp/GeoLite2-ASN.mmdb',os.environ['S3_BUCKET'],'GeoLite2-ASN.mmdb')
+    paths = []
+    for edition, (path, state) in zip(EDITIONS, results):
+        if state is None:
+            s3_client.download_file(os.environ['S3_BUCKET'], edition+'.mmdb', path, Config = TRANSFER)
+        paths.append(path)
 
     with open('/tmp/search.py', 'wb') as f:
         s3_client.download_fileobj(os.environ['S3_BUCKET'], 'search.py', f) 
     f.close()
 
-    with zipfile.ZipFile('/tmp/geoip2.zip', 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zipf:
+    index = os.environ.get('BUILD_INDEX', 'false') == 'true'
 
-        zipf.write('/tmp/search.py','search.py')
-        zipf.write('/tmp/GeoLite2-ASN.mmdb','GeoLite2-ASN.mmdb')
-        zipf.write('/tmp/GeoLite2-City.mmdb','GeoLite2-City.mmdb')
+    if index:
+        build_index('/tmp/GeoLite2-City.mmdb', '/tmp/GeoLite2-ASN.mmdb', '/tmp/GeoLite2-Index.bin')
+        if not benchmark('/tmp'):
+            raise ValueError('GeoLite2-Index.bin does not match the mmdb lookups')
 
-        for root, dirs, files in os.walk('/tmp/geoip2'):
-            for file in files:
-                fullpath = os.path.join(root, file)
-                zipf.write(fullpath, fullpath[5:])
+    merge = os.environ.get('MERGE_DATABASES', 'false') == 'true'
 
-        for root, dirs, files in os.walk('/tmp/maxminddb'):
+    if merge:
+        build_merged('/tmp/GeoLite2-City.mmdb', '/tmp/GeoLite2-ASN.mmdb', '/tmp/GeoLite2-City-ASN.mmdb')
+
+    reverse = os.environ.get('REVERSE_INDEX', 'false') == 'true'
+
+    if reverse:
+        build_reverse('/tmp/GeoLite2-City.mmdb', '/tmp/GeoLite2-ASN.mmdb', '/tmp/GeoLite2-Reverse.bin')
+
+    hot = int(os.environ.get('HOT_PREFIXES', '0'))
+
+    if hot > 0:
+        counts = mine_logs(s3_client, os.environ['LOG_BUCKET'], int(os.environ.get('HOT_DAYS', '7')), hot)
+        if not build_hot('/tmp', counts, hot, '/tmp/GeoLite2-Hot.bin')['identical']:
+            raise ValueError('GeoLite2-Hot.bin does not match the raw lookups')
+
+    pairs = []
+    for edition, path in zip(EDITIONS, paths):
+        if os.path.exists('/tmp/'+edition+'.previous.mmdb'):
+            pairs.append((edition, '/tmp/'+edition+'.previous.mmdb', path))
+
+    if pairs:
+        write_delta(pairs, '/tmp/GeoLite2-Delta.ndjson.gz')
+        s3_client.upload_file('/tmp/GeoLite2-Delta.ndjson.gz', os.environ['S3_BUCKET'], 'GeoLite2-Delta.ndjson.gz', Config = TRANSFER)
+
+    layer = os.environ.get('PUBLISH', 'function') == 'layer'
+
+    # a layer only carries data; the search code ships with the function
+    entries = [] if layer else [('/tmp/search.py','search.py')]
+
+    if merge:
+        entries.append(('/tmp/GeoLite2-City-ASN.mmdb','GeoLite2-City-ASN.mmdb'))
+
+    for edition, path in zip(EDITIONS, paths):
+        if merge and edition in ('GeoLite2-City', 'GeoLite2-ASN'):
+            continue
+        entries.append((path, edition+'.mmdb'))
+
+    if index:
+        entries.append(('/tmp/GeoLite2-Index.bin','GeoLite2-Index.bin'))
+
+    if reverse:
+        entries.append(('/tmp/GeoLite2-Reverse.bin','GeoLite2-Reverse.bin'))
+
+    if hot > 0:
+        entries.append(('/tmp/GeoLite2-Hot.bin','GeoLite2-Hot.bin'))
+
+    for directory in ([] if layer else ['/tmp/geoip2', '/tmp/maxminddb']):
+        for root, dirs, files in os.walk(directory):
             for file in files:
                 fullpath = os.path.join(root, file)
-                zipf.write(fullpath, fullpath[5:])
+                entries.append((fullpath, fullpath[5:]))
 
-    zipf.close()
+    profile = os.environ.get('PACKAGE_PROFILE', 'maximum')
+    stats = package('/tmp/geoip2.zip', entries, profile)
+    stats.update(measure('/tmp/geoip2.zip', '/tmp/measure'))
 
-    response = s3_client.upload_file('/tmp/geoip2.zip',os.environ['S3_BUCKET'],'geoip2.zip')
+    print(json.dumps({'package': stats}))
+
+    response = s3_client.upload_file(
+        '/tmp/geoip2.zip',
+        os.environ['S3_BUCKET'],
+        'geoip2.zip',
+        ExtraArgs = {'Metadata': {key: str(value) for key, value in stats.items()}},
+        Config = TRANSFER
+    )
 
     client = boto3.client('lambda')
 
-    response = client.update_function_code(
-        FunctionName = os.environ['LAMBDA_FUNCTION'],
-        S3Bucket = os.environ['S3_BUCKET'],
-        S3Key = 'geoip2.zip'
-    )
+    if layer:
+        builds = []
+        for edition, path in zip(EDITIONS, paths):
+            with maxminddb.open_database(path) as reader:
+                builds.append(edition+' '+str(reader.metadata().build_epoch))
+        response = client.publish_layer_version(
+            LayerName = os.environ['LAYER_NAME'],
+            Description = ', '.join(builds),
+            Content = {
+                'S3Bucket': os.environ['S3_BUCKET'],
+                'S3Key': 'geoip2.zip'
+            },
+            CompatibleRuntimes = ['python3.12'],
+            CompatibleArchitectures = ['arm64']
+        )
+        point(client, ssm, response['LayerVersionArn'])
+        prune(client, int(os.environ.get('LAYER_KEEP', '10')))
+    else:
+        response = client.update_function_code(
+            FunctionName = os.environ['LAMBDA_FUNCTION'],
+            S3Bucket = os.environ['S3_BUCKET'],
+            S3Key = 'geoip2.zip'
+        )
+        client.get_waiter('function_updated_v2').wait(FunctionName = os.environ['LAMBDA_FUNCTION'])
+
+    if event.get('force'):
+        invalidate()
 
     token = ssm.get_parameter(
         Name = os.environ['SSM_PARAMETER_GIT'], 
@@ -121,7 +1118,7 @@ def handler(event, context):
     }'''
 
     response = requests.post(
-        'https://api.github.com/repos/jblukach/maxmind-geolite2/releases',
+        os.environ.get('GITHUB_API', 'https://api.github.com')+'/repos/jblukach/maxmind-geolite2/releases',
         headers=headers,
         data=data
     )
@@ -139,16 +1136,29 @@ def handler(event, context):
         "name":"GeoLite2.zip"
     }
 
-    url = 'https://uploads.github.com/repos/jblukach/maxmind-geolite2/releases/'+str(response.json()['id'])+'/assets'
+    url = os.environ.get('GITHUB_UPLOADS', 'https://uploads.github.com')+'/repos/jblukach/maxmind-geolite2/releases/'+str(response.json()['id'])+'/assets'
 
     with open('/tmp/geoip2.zip', 'rb') as f:
-        data = f.read()
-    f.close()
-
-    response = requests.post(url, params=params, headers=headers, data=data)
+        response = requests.post(url, params=params, headers=headers, data=f)
 
     print(response.json())
 
+    if pairs:
+
+        params = {
+            "name":"GeoLite2-Delta.ndjson.gz"
+        }
+
+        with open('/tmp/GeoLite2-Delta.ndjson.gz', 'rb') as f:
+            response = requests.post(url, params=params, headers=headers, data=f)
+
+        print(response.json())
+
+    changed = [(edition, path, state) for edition, (path, state) in zip(EDITIONS, results) if state is not None]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(len(changed), 1)) as pool:
+        list(pool.map(lambda item: store(*item, s3_client), changed))
+
     return {
         'statusCode': 200,
         'body': json.dumps('This product includes GeoLite2 data created by MaxMind, available from https://www.maxmind.com.')
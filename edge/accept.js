@@ -0,0 +1,51 @@
+// Rewrites Accept to the format search.negotiate would pick, so the cache key
+// holds one of these values (or no Accept at all for pretty JSON).
+var FORMATS = [
+    'application/json',
+    'application/x-ndjson',
+    'text/csv',
+    'application/msgpack',
+    'application/x-msgpack'
+];
+
+function negotiate(accept) {
+
+    var ranked = accept.split(',').map(function (part, position) {
+        var items = part.split(';').map(function (item) { return item.trim(); });
+        var quality = 1.0;
+        items.slice(1).forEach(function (param) {
+            if (param.startsWith('q=')) {
+                quality = Number(param.slice(2));
+                if (isNaN(quality)) {
+                    quality = 0.0;
+                }
+            }
+        });
+        return {quality: quality, position: position, media: items[0].toLowerCase()};
+    });
+
+    ranked.sort(function (a, b) { return b.quality - a.quality || a.position - b.position; });
+
+    for (var i = 0; i < ranked.length; i++) {
+        if (ranked[i].quality > 0 && FORMATS.indexOf(ranked[i].media) >= 0) {
+            return ranked[i].media;
+        }
+    }
+
+    return null;
+}
+
+function handler(event) {
+
+    var request = event.request;
+    var accept = request.headers['accept'];
+    var media = accept ? negotiate(accept.value) : null;
+
+    if (media) {
+        request.headers['accept'] = {value: media};
+    } else {
+        delete request.headers['accept'];
+    }
+
+    return request;
+}
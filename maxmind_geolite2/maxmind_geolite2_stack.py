@@ -156,6 +156,28 @@ class MaxmindGeolite2Stack(Stack):
             layer_version_arn = 'arn:aws:lambda:'+region+':'+extensions.string_value+':layer:requests:5'
         )
 
+        # 'layer' ships the databases in /opt, 'function' inside the search zip in /var/task
+
+        publish = 'function'
+
+        if publish == 'layer':
+
+            databases = _ssm.StringParameter.from_string_parameter_attributes(
+                self, 'databases',
+                parameter_name = '/maxmind/geolite2/layer'
+            )
+
+            geolite2 = [
+                _lambda.LayerVersion.from_layer_version_arn(
+                    self, 'geolite2',
+                    layer_version_arn = databases.string_value
+                )
+            ]
+
+        else:
+
+            geolite2 = []
+
     ### CHATBOT ###
 
         workspace = _ssm.StringParameter.from_string_parameter_attributes(
@@ -292,10 +314,18 @@ class MaxmindGeolite2Stack(Stack):
             function_name = 'geo',
             runtime = _lambda.Runtime.PYTHON_3_12,
             architecture = _lambda.Architecture.ARM_64,
-            code = _lambda.Code.from_asset('search'),
+            code = _lambda.Code.from_asset('code' if publish == 'layer' else 'search'),
             handler = 'search.handler',
             environment = dict(
-                AWS_ACCOUNT = account
+                AWS_ACCOUNT = account,
+                BATCH_LIMIT = '1000',
+                CACHE_SIZE = '4096',
+                DATABASE_PATH = '/opt' if publish == 'layer' else '',
+                ENGINE = 'raw',
+                LOG_SAMPLE_RATE = '0.01',
+                MMDB_MODE = 'AUTO',
+                RANGE_LIMIT = '1000',
+                WARM_UP = 'false'
             ),
             timeout = Duration.seconds(7),
             role = role,
@@ -305,7 +335,7 @@ class MaxmindGeolite2Stack(Stack):
                 geoip2,
                 getpublicip,
                 maxminddb
-            ]
+            ] + geolite2
         )
 
         url = search.add_function_url(
@@ -351,10 +381,19 @@ class MaxmindGeolite2Stack(Stack):
         build.add_to_policy(
             _iam.PolicyStatement(
                 actions = [
+                    'cloudfront:CreateInvalidation',
+                    'lambda:DeleteLayerVersion',
+                    'lambda:GetFunctionConfiguration',
+                    'lambda:GetLayerVersion',
+                    'lambda:ListLayerVersions',
+                    'lambda:PublishLayerVersion',
                     'lambda:UpdateFunctionCode',
+                    'lambda:UpdateFunctionConfiguration',
                     's3:GetObject',
+                    's3:ListBucket',
                     's3:PutObject',
-                    'ssm:GetParameter'
+                    'ssm:GetParameter',
+                    'ssm:PutParameter'
                 ],
                 resources = [
                     '*'
@@ -371,9 +410,21 @@ class MaxmindGeolite2Stack(Stack):
             environment = dict(
                 AWS_ACCOUNT = account,
                 S3_BUCKET = bucket.bucket_name,
+                BUILD_DELTA = 'false',
+                BUILD_INDEX = 'false',
+                HOT_DAYS = '7',
+                HOT_PREFIXES = '10000',
+                LOG_BUCKET = 'maxmindgeolite2cloudfrontlogs',
+                MERGE_DATABASES = 'false',
+                LAYER_KEEP = '10',
+                LAYER_NAME = 'geolite2',
+                PACKAGE_PROFILE = 'maximum',
+                PUBLISH = publish,
+                REVERSE_INDEX = 'false',
                 SSM_PARAMETER_ACCT = '/maxmind/geolite2/account',
                 SSM_PARAMETER_KEY = '/maxmind/geolite2/api',
                 SSM_PARAMETER_GIT = '/github/releases',
+                SSM_PARAMETER_LAYER = '/maxmind/geolite2/layer',
                 LAMBDA_FUNCTION = search.function_name
             ),
             timeout = Duration.seconds(900),
@@ -381,7 +432,9 @@ class MaxmindGeolite2Stack(Stack):
             memory_size = 512,
             retry_attempts = 0,
             layers = [
+                geoip2,
                 getpublicip,
+                maxminddb,
                 requests
             ]
         )
@@ -483,13 +536,42 @@ class MaxmindGeolite2Stack(Stack):
 
     ### CLOUDFRONT ###
 
+        geocache = _cloudfront.CachePolicy(
+            self, 'geocache',
+            comment = 'geo.tundralabs.net',
+            default_ttl = Duration.days(1),
+            min_ttl = Duration.seconds(0),
+            max_ttl = Duration.days(4),
+            cookie_behavior = _cloudfront.CacheCookieBehavior.none(),
+            header_behavior = _cloudfront.CacheHeaderBehavior.allow_list('Accept'),
+            query_string_behavior = _cloudfront.CacheQueryStringBehavior.allow_list('after', 'fields', 'limit'),
+            enable_accept_encoding_brotli = True,
+            enable_accept_encoding_gzip = True
+        )
+
+        geoaccept = _cloudfront.Function(
+            self, 'geoaccept',
+            comment = 'Normalize Accept to the negotiated format',
+            code = _cloudfront.FunctionCode.from_file(
+                file_path = 'edge/accept.js'
+            ),
+            runtime = _cloudfront.FunctionRuntime.JS_2_0
+        )
+
         geodistribution = _cloudfront.Distribution(
             self, 'geodistribution',
             comment = 'geo.tundralabs.net',
             default_behavior = _cloudfront.BehaviorOptions(
                 origin = _origins.FunctionUrlOrigin(url),
                 viewer_protocol_policy = _cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
-                cache_policy = _cloudfront.CachePolicy.CACHING_DISABLED
+                allowed_methods = _cloudfront.AllowedMethods.ALLOW_ALL,
+                cache_policy = geocache,
+                function_associations = [
+                    _cloudfront.FunctionAssociation(
+                        function = geoaccept,
+                        event_type = _cloudfront.FunctionEventType.VIEWER_REQUEST
+                    )
+                ]
             ),
             domain_names = [
                 'geo.tundralabs.net'
@@ -510,6 +592,8 @@ class MaxmindGeolite2Stack(Stack):
             enable_ipv6 = True
         )
 
+        download.add_environment('DISTRIBUTION_ID', geodistribution.distribution_id)
+
     ### DNS ENTRY ###
 
         geourl = _route53.ARecord(
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import concurrent.futures
+import csv
+import geoip2.errors
+import gzip
+import io
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+FIELDS = ('country', 'c_iso', 'state', 's_iso', 'city', 'zip', 'latitude', 'longitude', 'cidr', 'asn', 'org', 'error')
+
+search = None
+
+def start(directory, engine):
+
+    global search
+
+    sys.stdout = open(os.devnull, 'w')
+    os.environ['ENGINE'] = engine
+    os.environ['LOG_SAMPLE_RATE'] = '0'
+    os.chdir(directory)
+    sys.path.insert(0, os.path.join(ROOT, 'code'))
+
+    import search
+
+def enrich(ips):
+
+    results = {}
+    for ip in ips:
+        try:
+            msg = search.lookup(ip)
+            results[ip] = {key: value for key, value in msg.items() if key != 'attribution'}
+        except ValueError:
+            results[ip] = {'error': 'Invalid Address'}
+        except geoip2.errors.AddressNotFoundError:
+            results[ip] = {'error': 'Where the Internet Ends'}
+
+    return results
+
+def source(path):
+
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, newline = '')
+
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rt', newline = '')
+    return open(path, newline = '')
+
+def records(stream, fmt, column):
+
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield row, row[column or 'ip'].strip()
+        return
+
+    names = None
+    for line in stream:
+        line = line.rstrip('\r\n')
+        if fmt == 'cloudfront':
+            if line.startswith('#Fields:'):
+                names = line[8:].split()
+                continue
+            if line.startswith('#') or not line:
+                continue
+            values = line.split('\t')
+            row = dict(zip(names, values))
+            yield row, row[column or 'c-ip']
+        else:
+            if not line:
+                continue
+            parts = line.split()
+            yield {'line': line}, parts[int(column or 0)] if len(parts) > int(column or 0) else ''
+
+def chunks(items, size):
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class Writer:
+
+    def __init__(self, path, fmt):
+        self.fmt = fmt
+        self.path = path
+        self.columns = None
+        self.parquet = None
+        if fmt != 'parquet':
+            self.stream = sys.stdout if path == '-' else open(path, 'w', newline = '')
+
+    def write(self, rows):
+        if self.columns is None:
+            self.columns = [key for key in rows[0] if key not in FIELDS] + list(FIELDS)
+            if self.fmt == 'csv':
+                self.csv = csv.DictWriter(self.stream, fieldnames = self.columns, extrasaction = 'ignore')
+                self.csv.writeheader()
+        if self.fmt == 'csv':
+            self.csv.writerows(rows)
+        elif self.fmt == 'ndjson':
+            for row in rows:
+                self.stream.write(json.dumps(row, separators = (',', ':'))+'\n')
+        else:
+            self.write_parquet(rows)
+
+    def write_parquet(self, rows):
+        import pyarrow
+        import pyarrow.parquet
+        if self.parquet is None:
+            types = {'latitude': pyarrow.float64(), 'longitude': pyarrow.float64(), 'asn': pyarrow.int64()}
+            self.schema = pyarrow.schema([(name, types.get(name, pyarrow.string())) for name in self.columns])
+            self.parquet = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+        table = pyarrow.Table.from_pylist([{name: row.get(name) for name in self.columns} for row in rows], schema = self.schema)
+        self.parquet.write_table(table)
+
+    def close(self):
+        if self.parquet is not None:
+            self.parquet.close()
+        elif self.fmt != 'parquet' and self.stream is not sys.stdout:
+            self.stream.close()
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Enrich IP-bearing logs with GeoLite2 City and ASN data.')
+    parser.add_argument('input', help = 'log or CSV file, gzip or plain, or - for stdin')
+    parser.add_argument('--input-format', choices = ['cloudfront', 'csv', 'text'], default = 'cloudfront')
+    parser.add_argument('--column', help = 'IP column: a name for cloudfront/csv (c-ip, ip) or a 0-based index for text')
+    parser.add_argument('--output', default = '-', help = 'output file, or - for stdout')
+    parser.add_argument('--output-format', choices = ['csv', 'ndjson', 'parquet'], default = 'csv')
+    parser.add_argument('--databases', default = '.', help = 'directory holding the GeoLite2 .mmdb files')
+    parser.add_argument('--engine', default = 'raw')
+    parser.add_argument('--workers', type = int, default = os.cpu_count())
+    parser.add_argument('--chunk', type = int, default = 5000)
+    parser.add_argument('--dedupe', action = 'store_true', help = 'look each distinct IP up once per run')
+    args = parser.parse_args()
+
+    if args.output_format == 'parquet' and args.output == '-':
+        parser.error('parquet output needs --output')
+
+    writer = Writer(args.output, args.output_format)
+    known = {}
+    pending = set()
+    window = collections.deque()
+
+    def flush(chunk, future):
+        results = future.result()
+        if args.dedupe:
+            known.update(results)
+            pending.difference_update(results)
+            results = known
+        writer.write([{**row, **results[ip]} for row, ip in chunk])
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers = args.workers,
+        initializer = start,
+        initargs = (os.path.abspath(args.databases), args.engine)
+    ) as pool:
+        with source(args.input) as stream:
+            for chunk in chunks(records(stream, args.input_format, args.column), args.chunk):
+                ips = dict.fromkeys(ip for row, ip in chunk)
+                if args.dedupe:
+                    ips = [ip for ip in ips if ip not in known and ip not in pending]
+                    pending.update(ips)
+                window.append((chunk, pool.submit(enrich, list(ips))))
+                while len(window) > args.workers * 2:
+                    flush(*window.popleft())
+            while window:
+                flush(*window.popleft())
+
+    writer.close()
+
+if __name__ == '__main__':
+    main()
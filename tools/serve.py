@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import base64
+import email.utils
+import http
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import time
+import traceback
+import urllib.parse
+import zipfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+KEEPALIVE = 15
+
+GRACE = 30
+
+MAX_BODY = 1024 * 1024
+
+search = None
+draining = False
+connections = set()
+idle = set()
+
+def event(method, target, headers, body, source):
+
+    path, _, query = target.partition('?')
+
+    parameters = {}
+    for key, value in urllib.parse.parse_qsl(query, keep_blank_values = True):
+        parameters[key] = parameters[key]+','+value if key in parameters else value
+
+    try:
+        text = body.decode()
+        encoded = False
+    except UnicodeDecodeError:
+        text = base64.b64encode(body).decode()
+        encoded = True
+
+    return {
+        'version': '2.0',
+        'rawPath': path,
+        'rawQueryString': query,
+        'headers': headers,
+        'queryStringParameters': parameters or None,
+        'requestContext': {
+            'http': {
+                'method': method,
+                'path': path,
+                'protocol': 'HTTP/1.1',
+                'sourceIp': source,
+                'userAgent': headers.get('user-agent', '')
+            }
+        },
+        'body': text if body else None,
+        'isBase64Encoded': encoded
+    }
+
+def reply(response, method, keep):
+
+    code = response['statusCode']
+    body = response.get('body') or ''
+    body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode()
+    if code == 304 or method == 'HEAD':
+        length = 0 if code == 304 else len(body)
+        body = b''
+    else:
+        length = len(body)
+
+    lines = ['HTTP/1.1 '+str(code)+' '+http.HTTPStatus(code).phrase]
+    for key, value in response.get('headers', {}).items():
+        lines.append(key+': '+str(value))
+    lines.append('Content-Length: '+str(length))
+    lines.append('Date: '+email.utils.formatdate(usegmt = True))
+    lines.append('Connection: '+('keep-alive' if keep else 'close'))
+
+    return ('\r\n'.join(lines)+'\r\n\r\n').encode('latin-1') + body
+
+def refuse(code):
+
+    return reply({'statusCode': code, 'headers': {'Content-Type': 'text/plain'}, 'body': http.HTTPStatus(code).phrase}, 'GET', False)
+
+async def connection(reader, writer):
+
+    task = asyncio.current_task()
+    connections.add(task)
+    peer = writer.get_extra_info('peername')
+    source = peer[0] if peer else ''
+
+    try:
+        while not draining:
+            idle.add(task)
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                break
+            finally:
+                idle.discard(task)
+
+            lines = head.decode('latin-1').split('\r\n')
+            try:
+                method, target, version = lines[0].split(' ')
+            except ValueError:
+                writer.write(refuse(400))
+                break
+
+            headers = {}
+            for line in lines[1:]:
+                if not line:
+                    continue
+                key, _, value = line.partition(':')
+                key = key.strip().lower()
+                headers[key] = headers[key]+','+value.strip() if key in headers else value.strip()
+
+            if 'chunked' in headers.get('transfer-encoding', ''):
+                writer.write(refuse(411))
+                break
+            try:
+                length = int(headers.get('content-length', '0'))
+            except ValueError:
+                writer.write(refuse(400))
+                break
+            if length > MAX_BODY:
+                writer.write(refuse(413))
+                break
+            try:
+                body = await reader.readexactly(length) if length else b''
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+
+            option = headers.get('connection', '').lower()
+            keep = not draining and (option == 'keep-alive' if version == 'HTTP/1.0' else option != 'close')
+
+            try:
+                response = search.handler(event(method, target, headers, body, source), None)
+            except Exception:
+                traceback.print_exc()
+                writer.write(refuse(500))
+                break
+            writer.write(reply(response, method, keep))
+            await writer.drain()
+
+            if not keep:
+                break
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        connections.discard(task)
+        writer.close()
+
+async def serve(sock, ready):
+
+    global draining
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    server = await asyncio.start_server(connection, sock = sock, backlog = 1024)
+    os.write(ready, b'1')
+    os.close(ready)
+
+    await stop.wait()
+
+    draining = True
+    server.close()
+    for task in idle:
+        task.cancel()
+    if connections:
+        done, pending = await asyncio.wait(set(connections), timeout = GRACE)
+        for task in pending:
+            task.cancel()
+
+def worker(sock, directory, ready, quiet):
+
+    global search
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+    os.chdir(directory)
+    if os.path.exists(os.path.join(directory, 'search.py')):
+        sys.path.insert(0, directory)
+    else:
+        sys.path.insert(0, os.path.join(ROOT, 'code'))
+
+    import search
+
+    asyncio.run(serve(sock, ready))
+
+def spawn(sock, directory, count, quiet):
+
+    pids = {}
+    for _ in range(count):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            code = 0
+            try:
+                worker(sock, directory, write, quiet)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        os.close(write)
+        pids[pid] = read
+
+    ready = set()
+    deadline = time.monotonic() + 60
+    while len(ready) < len(pids) and time.monotonic() < deadline:
+        readable, _, _ = select.select([fd for fd in pids.values() if fd not in ready], [], [], 1)
+        for fd in readable:
+            if os.read(fd, 1):
+                ready.add(fd)
+            else:
+                deadline = 0
+
+    for fd in pids.values():
+        os.close(fd)
+
+    if len(ready) < len(pids):
+        stop(pids)
+        return None
+
+    return set(pids)
+
+def stop(pids):
+
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+def deploy(release, root):
+
+    if os.path.isdir(release):
+        return os.path.abspath(release), False
+
+    directory = os.path.join(root, 'releases', str(os.stat(release).st_mtime_ns))
+    if not os.path.exists(directory):
+        with zipfile.ZipFile(release) as zipf:
+            zipf.extractall(directory+'.partial')
+        os.rename(directory+'.partial', directory)
+
+    return directory, True
+
+def fingerprint(release):
+
+    if os.path.isdir(release):
+        return None
+
+    return os.stat(release).st_mtime_ns
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Serve search.handler over HTTP/1.1 from pre-forked workers.')
+    parser.add_argument('release', help = 'GeoLite2.zip to serve and watch, or a directory holding its files')
+    parser.add_argument('--host', default = '0.0.0.0')
+    parser.add_argument('--port', type = int, default = 8080)
+    parser.add_argument('--workers', type = int, default = os.cpu_count())
+    parser.add_argument('--root', default = '/var/lib/geolite2', help = 'where zip releases are extracted')
+    parser.add_argument('--poll', type = float, default = 5, help = 'seconds between checks for a new zip')
+    parser.add_argument('--quiet', action = 'store_true', help = 'drop the per-request metrics that search.handler prints')
+    args = parser.parse_args()
+
+    sock = socket.create_server((args.host, args.port), family = socket.AF_INET6 if ':' in args.host else socket.AF_INET, backlog = 1024)
+    sock.setblocking(False)
+
+    signals = []
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+    directory, extracted = deploy(args.release, args.root)
+    current = fingerprint(args.release)
+    pids = spawn(sock, directory, args.workers, args.quiet)
+    if pids is None:
+        sys.exit('workers did not start for '+directory)
+    print('serving', directory, 'on', args.host, args.port, 'with', len(pids), 'workers', flush = True)
+
+    checked = time.monotonic()
+    while True:
+        time.sleep(0.2)
+
+        if signal.SIGTERM in signals or signal.SIGINT in signals:
+            stop(pids)
+            return
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in pids:
+                pids.discard(pid)
+                pids |= spawn(sock, directory, 1, args.quiet) or set()
+
+        swap = signal.SIGHUP in signals
+        if time.monotonic() - checked >= args.poll:
+            checked = time.monotonic()
+            try:
+                swap = swap or fingerprint(args.release) != current
+            except OSError:
+                pass
+        signals.clear()
+        if not swap:
+            continue
+
+        try:
+            fresh, fresh_extracted = deploy(args.release, args.root)
+            fresh_pids = spawn(sock, fresh, args.workers, args.quiet)
+        except (OSError, zipfile.BadZipFile) as error:
+            print('keeping', directory, 'after', repr(error), flush = True)
+            current = fingerprint(args.release)
+            continue
+        if fresh_pids is None:
+            print('keeping', directory, 'because', fresh, 'did not start', flush = True)
+            current = fingerprint(args.release)
+            continue
+
+        stop(pids)
+        if extracted and fresh != directory:
+            shutil.rmtree(directory, ignore_errors = True)
+        pids, directory, extracted = fresh_pids, fresh, fresh_extracted
+        current = fingerprint(args.release)
+        print('serving', directory, 'with', len(pids), 'workers', flush = True)
+
+if __name__ == '__main__':
+    main()